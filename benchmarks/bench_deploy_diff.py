@@ -0,0 +1,62 @@
+"""
+Benchmark the CodeDeploy lifecycle-event diff engine.
+
+Simulates a deployment of 1,000 instances x 13 lifecycle events where one more
+event per instance finishes on every poll, and times LifecycleDiff.update per tick.
+
+    python3 benchmarks/bench_deploy_diff.py --instances 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deploy_diff import LifecycleDiff  # noqa: E402
+
+LIFECYCLE_EVENTS = [
+    "ApplicationStop", "DownloadBundle", "BeforeInstall", "Install", "AfterInstall", "ApplicationStart",
+    "ValidateService", "BeforeBlockTraffic", "BlockTraffic", "AfterBlockTraffic", "BeforeAllowTraffic",
+    "AllowTraffic", "AfterAllowTraffic",
+]
+
+
+def make_snapshot(instances: int, tick: int) -> list:
+    instances_summary = []
+    for i in range(instances):
+        lifecycle_events = []
+        for n, lifecycle_event_name in enumerate(LIFECYCLE_EVENTS):
+            if n < tick:
+                status = "Succeeded"
+            elif n == tick:
+                status = "InProgress"
+            else:
+                status = "Pending"
+            lifecycle_events.append({"lifecycleEventName": lifecycle_event_name, "status": status})
+        instances_summary.append({
+            "instanceId": f"arn:aws:ec2:eu-west-1:123456789012:instance/i-{i:017x}",
+            "instanceType": "Blue",
+            "lifecycleEvents": lifecycle_events,
+        })
+    return instances_summary
+
+
+def main(args: argparse.Namespace) -> None:
+    snapshots = [make_snapshot(args.instances, tick) for tick in range(len(LIFECYCLE_EVENTS) + 1)]
+
+    lifecycle_diff = LifecycleDiff()
+    timings, transitions = [], 0
+    for snapshot in snapshots:
+        start = time.perf_counter()
+        transitions += len(lifecycle_diff.update(snapshot))
+        timings.append(time.perf_counter() - start)
+
+    print(f"instances={args.instances} events={len(LIFECYCLE_EVENTS)} ticks={len(snapshots)} transitions={transitions}")
+    print(f"per tick: mean={sum(timings) / len(timings) * 1000:.2f}ms max={max(timings) * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the CodeDeploy lifecycle-event diff engine')
+    parser.add_argument('--instances', default=1000, type=int)
+    main(parser.parse_args())
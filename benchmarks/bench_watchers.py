@@ -0,0 +1,174 @@
+"""
+Offline benchmark for the CodeBuild/CodeDeploy watchers.
+
+Replays scripted timelines through botocore (see scripted_aws.py) and points every
+SlackProgress at a local fake Slack server (see fake_slack.py), then reports:
+- AWS API calls per build/deployment, and how many were throttled
+- Slack calls and bytes sent, and how many were answered 429
+- CPU time of the poll loop
+- latency from each simulated transition to the first Slack message showing it,
+  in simulated seconds. Slack rate limits, flush timers and retry backoffs run on the
+  simulated clock too, only the HTTP round-trips to the fake servers are not scaled.
+
+    python3 benchmarks/bench_watchers.py build --builds 1 5
+    python3 benchmarks/bench_watchers.py batch --children 10 50
+    python3 benchmarks/bench_watchers.py deploy --instances 1 10 100 1000 --history
+    python3 benchmarks/bench_watchers.py deploy --instances 100 --throttle_rate 0.05 --ratelimit_every 20
+    python3 benchmarks/bench_watchers.py deploy --instances 10 --sinks 3
+    python3 benchmarks/bench_watchers.py build --builds 3 --events --foreign_events 20
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import code_build  # noqa: E402
+import code_deploy  # noqa: E402
+import event_source  # noqa: E402
+import progress_bar  # noqa: E402
+import retry  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from progress_bar import SlackTransport, TokenBucket  # noqa: E402
+from retry import Retrier  # noqa: E402
+
+from fake_slack import FakeSlackServer  # noqa: E402
+from scripted_aws import ScaledAsyncio, ScaledThreading, ScaledTime, ScriptedAws, SimulatedClock  # noqa: E402
+
+BUILD_PHASE_RE = re.compile(r"CodeBuild: (?P<project>[^*]+)\*>|Build's Phase: (?P<phase>\w+), PhaseStatus=\*(?P<phase_status>\w+)\*|Build: \*(?P<build_project>[^*]+)\*, BuildStatus=`(?P<build_status>\w+)`")
+DEPLOY_EVENT_RE = re.compile(r"Deployment's Phase: (?P<event>\w+), \[.*?\|\*(?P<instance>[\w-]+)\*>\] PhaseStatus=\*(?P<status>\w+)\*")
+
+
+def first_seen(fake_slack: FakeSlackServer, clock: SimulatedClock, scenario: str) -> dict:
+    """
+    Simulated time at which each transition first showed up in Slack
+    """
+    seen, owners = {}, {}
+    for call in fake_slack.calls:
+        at = clock.real_to_sim(call["at"])
+        project = owners.get(call["thread_ts"] or call["ts"])
+        for line in call["text"].splitlines():
+            if scenario == "deploy":
+                match = DEPLOY_EVENT_RE.search(line)
+                if match:
+                    seen.setdefault(("event", match["instance"], match["event"], match["status"]), at)
+                continue
+
+            match = BUILD_PHASE_RE.search(line)
+            if not match:
+                continue
+            if match["project"]:
+                project = owners[call["ts"]] = match["project"]
+            elif match["phase"]:
+                seen.setdefault(("phase", project, match["phase"], match["phase_status"]), at)
+            elif match["build_status"] != "IN_PROGRESS":
+                seen.setdefault(("build", match["build_project"], match["build_status"]), at)
+    return seen
+
+
+BENCHMARK_QUEUE_URL = "https://sqs.eu-west-1.amazonaws.com/123456789012/benchmark"
+
+
+def reset_shared_state() -> None:
+    """
+    Forget the rate limiters, retriers (and their circuit breakers) and metrics of the previous run,
+    their timestamps are on its simulated clock
+    """
+    with TokenBucket._buckets_lock:
+        TokenBucket._buckets.clear()
+    with Retrier._retriers_lock:
+        Retrier._retriers.clear()
+    with Metrics._shared_lock:
+        Metrics._shared = None
+
+
+def run(args: argparse.Namespace, size: int) -> None:
+    reset_shared_state()
+    clock = SimulatedClock(args.time_scale)
+    aws = ScriptedAws(clock, throttle_rate=args.throttle_rate, history=args.history)
+    aws.install()
+    aws.add_foreign_events(args.foreign_events)
+    fake_slack = FakeSlackServer(ratelimit_every=args.ratelimit_every).start()
+    SlackTransport.configure(base_url=fake_slack.base_url)
+    workdir = tempfile.mkdtemp(prefix="bench-watchers-")
+
+    common = dict(
+        slack_token="xoxb-benchmark", channel_name="C0FAKE", iam_slack_usernames_mapping="{}", aws_region="eu-west-1",
+        phase_durations_cache=os.path.join(workdir, "durations.json"), startup_cache=os.path.join(workdir, "startup.json"),
+        checkpoint_path=os.path.join(workdir, "checkpoint.json"), resume=False, profile_startup=False,
+        sqs_queue_url=BENCHMARK_QUEUE_URL if args.events else "", sqs_endpoint_url="", reconcile_interval=60, metrics_path="", tail_logs=0, poll_cache_ttl=0, poll_cache_dir="",
+    )
+    event_source.time = ScaledTime(clock)
+    # Slack token buckets, write-behind flush timers and retry backoffs, so a Slack edit costs
+    # what it would for real rather than a whole second of real time
+    progress_bar.time, progress_bar.asyncio, progress_bar.threading = ScaledTime(clock), ScaledAsyncio(clock), ScaledThreading(clock)
+    retry.time, retry.asyncio = ScaledTime(clock), ScaledAsyncio(clock)
+    if args.scenario == "build":
+        code_build.time = ScaledTime(clock)
+        project_names = [f"project-{n}" for n in range(size)]
+        timelines = [aws.add_build(project_name) for project_name in project_names]
+        watcher, watcher_args = code_build.watch, argparse.Namespace(project_name="", project_names=project_names, build_ids=[], **common)
+    elif args.scenario == "batch":
+        code_build.time = ScaledTime(clock)
+        timelines = [aws.add_build_batch("project-batch", size)]
+        watcher, watcher_args = code_build.watch_batch, argparse.Namespace(project_name="project-batch", **common)
+    else:
+        code_deploy.time = ScaledTime(clock)
+        timelines = [aws.add_deployment(size)]
+        watcher, watcher_args = code_deploy.main, argparse.Namespace(
+            project_name="benchmark", deployment_group_name="benchmark", deployment_id=timelines[0].deployment_id, slack_link="",
+            commit_id="", ssh_git_repo_url="", git_repo_branch="", repository_name="", max_workers=8, summary=args.summary,
+            extra_sinks=json.dumps([{"slack_token": "xoxb-benchmark", "channel_name": f"C0FAKE{n}"} for n in range(1, args.sinks)]), **common
+        )
+
+    cpu_started_at, started_at, error = time.thread_time(), time.monotonic(), None
+    try:
+        watcher(watcher_args)
+    except Exception as err:
+        error = err
+    cpu_seconds, wall_seconds = time.thread_time() - cpu_started_at, time.monotonic() - started_at
+    SlackTransport.shared().close()
+    fake_slack.stop()
+
+    seen = first_seen(fake_slack, clock, args.scenario)
+    latencies = [seen[key] - at for timeline in timelines for at, key in timeline.changes() if key in seen]
+    missing = sum(1 for timeline in timelines for _, key in timeline.changes() if key not in seen)
+
+    label = {"build": "builds", "batch": "children", "deploy": "instances"}[args.scenario]
+    print(f"{args.scenario} {label}={size} sinks={args.sinks} history={args.history} events={args.events} throttle_rate={args.throttle_rate} ratelimit_every={args.ratelimit_every}")
+    if error:
+        print(f"  watcher crashed: {error!r}")
+    print(f"  wall={wall_seconds:.2f}s poll-loop cpu={cpu_seconds:.3f}s")
+    print(f"  aws calls={sum(aws.calls.values())} ({sum(aws.calls.values()) / len(timelines):.1f} per {args.scenario}) throttled={sum(aws.throttled.values())} {dict(aws.calls)}")
+    if args.events:
+        print(f"  queue: deleted={aws.queue.deleted} left={aws.queue.pending()}")
+    print(f"  slack calls={len(fake_slack.calls)} bytes={fake_slack.bytes_received} ratelimited={fake_slack.ratelimited}")
+    if latencies:
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"  latency (sim sec): mean={statistics.mean(latencies):.1f} p50={statistics.median(latencies):.1f} p95={p95:.1f} max={latencies[-1]:.1f} missing={missing}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmark for the CodeBuild/CodeDeploy watchers')
+    parser.add_argument('scenario', choices=['build', 'batch', 'deploy'])
+    parser.add_argument('--builds', nargs='*', default=[1], type=int)
+    parser.add_argument('--children', nargs='*', default=[10, 50], type=int)
+    parser.add_argument('--instances', nargs='*', default=[1, 10, 100], type=int)
+    parser.add_argument('--history', action='store_true', help="serve history so adaptive polling kicks in")
+    parser.add_argument('--throttle_rate', default=0.0, type=float)
+    parser.add_argument('--ratelimit_every', default=0, type=int)
+    parser.add_argument('--time_scale', default=0.02, type=float)
+    parser.add_argument('--sinks', default=1, type=int, help="Slack channels fed from one deploy watcher")
+    parser.add_argument('--events', action='store_true', help="event-driven mode, fed from an in-memory SQS stand-in")
+    parser.add_argument('--foreign_events', default=0, type=int, help="queue events of builds other watchers follow, to check they are not spun on")
+    parser.add_argument('--summary', action='store_true', help="fleet summary instead of a line per instance, deploy only (per-instance latencies are not measured)")
+    args = parser.parse_args()
+
+    for size in {"build": args.builds, "batch": args.children, "deploy": args.instances}[args.scenario]:
+        run(args, size)
@@ -0,0 +1,54 @@
+"""
+Checks SqsEventSource against the in-memory SQS stand-in of scripted_aws.py:
+events of other watchers are released without being received over and over,
+stale events are deleted, and the watcher's own events are returned.
+
+    python3 benchmarks/check_event_source.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import event_source  # noqa: E402
+from event_source import BUILD_PHASE_CHANGE, SqsEventSource, build_id_from_event  # noqa: E402
+
+from scripted_aws import ScaledTime, ScriptedAws, SimulatedClock  # noqa: E402
+
+QUEUE_URL = "https://sqs.eu-west-1.amazonaws.com/123456789012/benchmark"
+
+
+def main() -> None:
+    import boto3
+
+    clock = SimulatedClock(0.01)
+    event_source.time = ScaledTime(clock)
+    aws = ScriptedAws(clock)
+    aws.install()
+    aws.add_foreign_events(25)
+    source = SqsEventSource(boto3.client("sqs"), QUEUE_URL)
+
+    # only other watchers' events: the wait runs out after a handful of receives
+    events = source.wait(60, accept=lambda event: False)
+    assert events == [], events
+    assert aws.calls["ReceiveMessage"] <= 10, aws.calls
+    assert aws.queue.deleted == 25, "finished builds' events were not deleted"
+    assert aws.queue.pending() == 25, "running builds' events were not left for their watchers"
+
+    # the watcher's own event is returned as soon as it shows up, and deleted
+    arn = "arn:aws:codebuild:eu-west-1:123456789012:build/project:own"
+    aws.queue.send({"detail-type": BUILD_PHASE_CHANGE, "detail": {"build-id": arn, "completed-phase": "BUILD", "completed-phase-status": "SUCCEEDED"}}, clock.now() + 5)
+    events = source.wait(60, accept=lambda event: build_id_from_event(event) == "project:own")
+    assert [build_id_from_event(event) for event in events] == ["project:own"], events
+    assert aws.queue.pending() == 25
+
+    # late events of a build the watcher has finished with are dropped
+    aws.queue.send({"detail-type": BUILD_PHASE_CHANGE, "detail": {"build-id": arn, "completed-phase": "POST_BUILD", "completed-phase-status": "SUCCEEDED"}}, clock.now())
+    source.wait(15, accept=lambda event: False, drop=lambda event: build_id_from_event(event) == "project:own")
+    assert aws.queue.pending() == 25
+
+    print(f"ok: {dict(aws.calls)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Local stand-in for the Slack Web API: records every call and can answer 429s.
+
+Only the methods the progress bars use are implemented (chat.postMessage, chat.update).
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+
+
+class FakeSlackServer(object):
+    """
+    params:
+        - ratelimit_every(int): answer every Nth call with 429, 0 to never rate limit
+        - retry_after(int): `Retry-After` sent with each 429
+    """
+
+    def __init__(self, ratelimit_every=0, retry_after=1):
+        self.ratelimit_every = ratelimit_every
+        self.retry_after = retry_after
+        self.calls = []
+        self.ratelimited = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._ts = itertools.count(1)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/api/"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                method = self.path.rpartition("/")[-1]
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+
+                with server._lock:
+                    server.bytes_received += len(body)
+                    n = next(server._counter)
+                    if server.ratelimit_every and n % server.ratelimit_every == 0:
+                        server.ratelimited += 1
+                        self._reply(429, {"ok": False, "error": "ratelimited"}, {"Retry-After": str(server.retry_after)})
+                        return
+
+                    if method == "chat.postMessage":
+                        ts = f"{int(time.time())}.{next(server._ts):06d}"
+                    else:
+                        ts = params.get("ts")
+                    server.calls.append({
+                        "at": time.monotonic(),
+                        "method": method,
+                        "channel": params.get("channel"),
+                        "ts": ts,
+                        "thread_ts": params.get("thread_ts"),
+                        "text": params.get("text", ""),
+                        "bytes": len(body),
+                    })
+                self._reply(200, {"ok": True, "channel": "C0FAKE", "ts": ts})
+
+            def _reply(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
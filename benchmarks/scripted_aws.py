@@ -0,0 +1,448 @@
+"""
+Scripted CodeBuild/CodeDeploy timelines served through botocore.
+
+Responses are injected with a `before-call` handler on the default boto3 session,
+the same hook botocore's Stubber uses, so requests still go through botocore's
+parameter validation but never leave the process. Time runs on a simulated clock
+that `time_scale` compresses, so a 10 minute build replays in seconds.
+"""
+import asyncio
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+import json
+import random
+import threading
+import time
+
+from event_source import BUILD_PHASE_CHANGE, BUILD_STATE_CHANGE, DEPLOYMENT_STATE_CHANGE, INSTANCE_STATE_CHANGE
+
+BUILD_PHASES = [
+    ("SUBMITTED", 1), ("QUEUED", 20), ("PROVISIONING", 30), ("DOWNLOAD_SOURCE", 5), ("INSTALL", 20),
+    ("PRE_BUILD", 5), ("BUILD", 120), ("POST_BUILD", 30), ("UPLOAD_ARTIFACTS", 5), ("FINALIZING", 5), ("COMPLETED", 0),
+]
+
+LIFECYCLE_EVENTS = [
+    ("ApplicationStop", 5), ("DownloadBundle", 10), ("BeforeInstall", 5), ("Install", 15), ("AfterInstall", 30),
+    ("ApplicationStart", 10), ("ValidateService", 20), ("BeforeBlockTraffic", 1), ("BlockTraffic", 1),
+    ("AfterBlockTraffic", 1), ("BeforeAllowTraffic", 1), ("AllowTraffic", 1), ("AfterAllowTraffic", 1),
+]
+
+
+class SimulatedClock(object):
+    """
+    Simulated seconds since start; one simulated second lasts `time_scale` real seconds
+    """
+
+    def __init__(self, time_scale: float):
+        self.time_scale = time_scale
+        self.started_at = time.monotonic()
+
+    def now(self) -> float:
+        return (time.monotonic() - self.started_at) / self.time_scale
+
+    def real_to_sim(self, monotonic_at: float) -> float:
+        return (monotonic_at - self.started_at) / self.time_scale
+
+    def datetime_at(self, sim_at: float) -> datetime:
+        # shown as if simulated time had really passed, so AdaptivePoller sees simulated durations
+        return datetime.now(timezone.utc) - timedelta(seconds=self.now() - sim_at)
+
+
+class ScaledTime(object):
+    """
+    Stand-in for the `time` module of a watcher script whose sleeps run on the simulated clock
+    """
+
+    def __init__(self, clock: SimulatedClock):
+        self._clock = clock
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self._clock.time_scale)
+
+    def monotonic(self):
+        return self._clock.now()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class ScaledAsyncio(object):
+    """
+    Stand-in for the `asyncio` module of a module whose coroutine sleeps run on the simulated clock
+    """
+
+    def __init__(self, clock: SimulatedClock):
+        self._clock = clock
+
+    def sleep(self, seconds, *args, **kwargs):
+        return asyncio.sleep(seconds * self._clock.time_scale, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+
+class ScaledThreading(object):
+    """
+    Stand-in for the `threading` module of a module whose timers run on the simulated clock
+    """
+
+    def __init__(self, clock: SimulatedClock):
+        self._clock = clock
+
+    def Timer(self, interval, function, *args, **kwargs):
+        return threading.Timer(interval * self._clock.time_scale, function, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(threading, name)
+
+
+class BuildTimeline(object):
+    def __init__(self, clock: SimulatedClock, project_name: str, started_at: float, build_id=None):
+        self.clock = clock
+        self.project_name = project_name
+        self.build_id = build_id or f"{project_name}:00000000-0000-0000-0000-{abs(hash(project_name)) % 10 ** 12:012d}"
+        self.started_at = started_at
+
+    def changes(self) -> list:
+        """
+        (simulated time, key) of every transition the watcher should post
+        """
+        changes, at = [], self.started_at
+        for phase_type, duration in BUILD_PHASES[:-1]:
+            at += duration
+            changes.append((at, ("phase", self.project_name, phase_type, "SUCCEEDED")))
+        changes.append((at, ("build", self.project_name, "SUCCEEDED")))
+        return changes
+
+    def events(self) -> list:
+        """
+        (simulated time, EventBridge event) of every phase and state change
+        """
+        arn = f"arn:aws:codebuild:eu-west-1:123456789012:build/{self.build_id}"
+        events, at = [], self.started_at
+        for phase_type, duration in BUILD_PHASES[:-1]:
+            at += duration
+            detail = {"build-id": arn, "project-name": self.project_name, "completed-phase": phase_type, "completed-phase-status": "SUCCEEDED"}
+            events.append((at, {"detail-type": BUILD_PHASE_CHANGE, "detail": detail}))
+        detail = {"build-id": arn, "project-name": self.project_name, "build-status": "SUCCEEDED"}
+        events.append((at, {"detail-type": BUILD_STATE_CHANGE, "detail": detail}))
+        return events
+
+    def build(self, now: float) -> dict:
+        phases, at = [], self.started_at
+        for phase_type, duration in BUILD_PHASES:
+            if at > now:
+                break
+            phase = {"phaseType": phase_type, "startTime": self.clock.datetime_at(at)}
+            if phase_type != "COMPLETED" and at + duration <= now:
+                phase.update(phaseStatus="SUCCEEDED", endTime=self.clock.datetime_at(at + duration), durationInSeconds=duration)
+            phases.append(phase)
+            at += duration
+        build_status = "SUCCEEDED" if now >= at else "IN_PROGRESS"
+        current_phase = phases[-1]["phaseType"] if phases else "SUBMITTED"
+        return {"id": self.build_id, "projectName": self.project_name, "buildStatus": build_status, "currentPhase": current_phase, "phases": phases, "logs": {}}
+
+    def finished_at(self) -> float:
+        return self.started_at + sum(duration for _, duration in BUILD_PHASES)
+
+
+class BuildBatchTimeline(object):
+    """
+    Batch build whose children start in waves of `parallel`, like a build matrix with limited concurrency
+    """
+
+    def __init__(self, clock: SimulatedClock, project_name: str, children: int, started_at: float, parallel=10):
+        self.clock = clock
+        self.project_name = project_name
+        self.batch_id = f"{project_name}:batch-00000000-0000-0000-0000-000000000000"
+        self.children = OrderedDict()
+        for n in range(children):
+            child_started_at = started_at + (n // parallel) * 60
+            build_id = f"{project_name}:child-{n:04d}-0000-0000-0000-000000000000"
+            self.children[f"build{n + 1}"] = BuildTimeline(clock, project_name, child_started_at, build_id=build_id)
+
+    def changes(self) -> list:
+        return [(child.finished_at(), ("build", identifier, "SUCCEEDED")) for identifier, child in self.children.items()]
+
+    def build_batch(self, now: float) -> dict:
+        build_groups = []
+        for identifier, child in self.children.items():
+            build_group = {"identifier": identifier}
+            if child.started_at <= now:
+                build_status = "SUCCEEDED" if now >= child.finished_at() else "IN_PROGRESS"
+                build_group["currentBuildSummary"] = {"arn": f"arn:aws:codebuild:eu-west-1:123456789012:build/{child.build_id}", "buildStatus": build_status}
+            build_groups.append(build_group)
+        finished = now >= max(child.finished_at() for child in self.children.values())
+        return {
+            "id": self.batch_id,
+            "projectName": self.project_name,
+            "buildBatchStatus": "SUCCEEDED" if finished else "IN_PROGRESS",
+            "buildGroups": build_groups,
+        }
+
+
+class DeployTimeline(object):
+    def __init__(self, clock: SimulatedClock, instances: int, started_at: float):
+        self.clock = clock
+        self.deployment_id = "d-BENCHMARK"
+        self.instance_ids = [f"i-{i:017x}" for i in range(instances)]
+        self.started_at = started_at
+
+    def _offset(self, n: int) -> float:
+        # stagger instances a little so transitions do not all land on one tick
+        return self.started_at + n % 10
+
+    def changes(self) -> list:
+        changes = []
+        for n, instance_id in enumerate(self.instance_ids):
+            at = self._offset(n)
+            for lifecycle_event_name, duration in LIFECYCLE_EVENTS:
+                at += duration
+                changes.append((at, ("event", instance_id, lifecycle_event_name, "Succeeded")))
+        return changes
+
+    def finished_at(self) -> float:
+        return self._offset(9) + sum(duration for _, duration in LIFECYCLE_EVENTS)
+
+    def instance_finished_at(self, n: int) -> float:
+        return self._offset(n) + sum(duration for _, duration in LIFECYCLE_EVENTS)
+
+    def events(self) -> list:
+        """
+        (simulated time, EventBridge event) of every instance finishing, then of the deployment
+        """
+        duration = sum(duration for _, duration in LIFECYCLE_EVENTS)
+        events = [
+            (self._offset(n) + duration, {"detail-type": INSTANCE_STATE_CHANGE, "detail": {"deploymentId": self.deployment_id, "instanceId": instance_id, "state": "SUCCESS"}})
+            for n, instance_id in enumerate(self.instance_ids)
+        ]
+        events.append((self.finished_at(), {"detail-type": DEPLOYMENT_STATE_CHANGE, "detail": {"deploymentId": self.deployment_id, "state": "SUCCESS"}}))
+        return events
+
+    def target(self, n: int, now: float) -> dict:
+        at, lifecycle_events = self._offset(n), []
+        for lifecycle_event_name, duration in LIFECYCLE_EVENTS:
+            event = {"lifecycleEventName": lifecycle_event_name, "status": "Pending"}
+            if at <= now:
+                event.update(status="InProgress", startTime=self.clock.datetime_at(at))
+            if at + duration <= now:
+                event.update(status="Succeeded", endTime=self.clock.datetime_at(at + duration))
+            lifecycle_events.append(event)
+            at += duration
+        status = "Succeeded" if at <= now else "InProgress"
+        instance_id = self.instance_ids[n]
+        return {
+            "deploymentTargetType": "InstanceTarget",
+            "instanceTarget": {
+                "deploymentId": self.deployment_id,
+                "targetId": instance_id,
+                "targetArn": f"arn:aws:ec2:eu-west-1:123456789012:instance/{instance_id}",
+                "status": status,
+                "lifecycleEvents": lifecycle_events,
+                "instanceLabel": "Blue",
+            },
+        }
+
+
+class ScriptedQueue(object):
+    """
+    In-memory stand-in for the SQS queue an EventBridge rule feeds: messages turn visible
+    at their simulated time, received messages stay hidden for their visibility timeout,
+    and long polls wait on the simulated clock
+    """
+
+    def __init__(self, clock: SimulatedClock, visibility_timeout=30):
+        self.clock = clock
+        self.visibility_timeout = visibility_timeout
+        self.deleted = 0
+        self._messages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def send(self, event: dict, at: float) -> None:
+        with self._lock:
+            message_id = f"m-{len(self._messages) + self.deleted:08d}"
+            self._messages[message_id] = {"body": json.dumps(event), "visible_at": at, "receipt": None}
+
+    def receive(self, max_messages: int, wait_seconds: float) -> list:
+        deadline = self.clock.now() + wait_seconds
+        while True:
+            now = self.clock.now()
+            with self._lock:
+                received = []
+                for message_id, message in self._messages.items():
+                    if message["visible_at"] <= now and len(received) < max_messages:
+                        message["visible_at"] = now + self.visibility_timeout
+                        message["receipt"] = f"{message_id}:{now}"
+                        received.append({"MessageId": message_id, "ReceiptHandle": message["receipt"], "Body": message["body"]})
+            if received or now >= deadline:
+                return received
+            time.sleep(0.5 * self.clock.time_scale)
+
+    def delete(self, receipt_handle: str) -> None:
+        with self._lock:
+            message_id = receipt_handle.partition(":")[0]
+            if self._messages.get(message_id, {}).get("receipt") == receipt_handle:
+                del self._messages[message_id]
+                self.deleted += 1
+
+    def change_visibility(self, receipt_handle: str, visibility_timeout: float) -> None:
+        with self._lock:
+            message = self._messages.get(receipt_handle.partition(":")[0])
+            if message and message["receipt"] == receipt_handle:
+                message["visible_at"] = self.clock.now() + visibility_timeout
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._messages)
+
+
+class ScriptedAws(object):
+    """
+    Serves scripted timelines to every boto3 client created from the default session
+    params:
+        - throttle_rate(float): share of calls answered with ThrottlingException
+        - history(bool): serve past builds/deployments, so phase durations can be learned
+    """
+
+    def __init__(self, clock: SimulatedClock, throttle_rate=0.0, history=False, seed=0):
+        self.clock = clock
+        self.throttle_rate = throttle_rate
+        self.history = history
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.builds = {}
+        self.build_batches = {}
+        self.deployment = None
+        self.queue = ScriptedQueue(clock)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def install(self, region_name="eu-west-1") -> None:
+        import boto3
+
+        boto3.setup_default_session(region_name=region_name, aws_access_key_id="testing", aws_secret_access_key="testing")
+        for service in ("sts", "codebuild", "codedeploy", "sqs"):
+            boto3.DEFAULT_SESSION.events.register(f"before-parameter-build.{service}", self._keep_params)
+            boto3.DEFAULT_SESSION.events.register(f"before-call.{service}", self._before_call)
+
+    def add_build(self, project_name: str) -> BuildTimeline:
+        timeline = BuildTimeline(self.clock, project_name, self.clock.now())
+        self.builds[project_name] = timeline
+        for at, event in timeline.events():
+            self.queue.send(event, at)
+        return timeline
+
+    def add_build_batch(self, project_name: str, children: int) -> BuildBatchTimeline:
+        timeline = BuildBatchTimeline(self.clock, project_name, children, self.clock.now())
+        self.build_batches[project_name] = timeline
+        return timeline
+
+    def add_deployment(self, instances: int) -> DeployTimeline:
+        self.deployment = DeployTimeline(self.clock, instances, self.clock.now())
+        for at, event in self.deployment.events():
+            self.queue.send(event, at)
+        return self.deployment
+
+    def add_foreign_events(self, count: int) -> None:
+        """
+        Queue events of builds other watchers follow: `count` of builds still running, `count` of finished ones
+        """
+        for n in range(count):
+            arn = f"arn:aws:codebuild:eu-west-1:123456789012:build/other-project:{n:08d}"
+            self.queue.send({"detail-type": BUILD_PHASE_CHANGE, "detail": {"build-id": arn, "completed-phase": "QUEUED", "completed-phase-status": "SUCCEEDED"}}, 0)
+            self.queue.send({"detail-type": BUILD_STATE_CHANGE, "detail": {"build-id": arn, "build-status": "SUCCEEDED"}}, 0)
+
+    @staticmethod
+    def _keep_params(params, context, **kwargs):
+        # before-call only sees the serialized request, keep the API params for it
+        context["scripted_params"] = dict(params)
+
+    def _before_call(self, model, context, **kwargs):
+        from botocore.awsrequest import AWSResponse
+
+        operation = model.name
+        with self._lock:
+            self.calls[operation] += 1
+            throttle = self._random.random() < self.throttle_rate
+            if throttle:
+                self.throttled[operation] += 1
+        if throttle:
+            error = {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}, "ResponseMetadata": {"HTTPStatusCode": 400}}
+            return AWSResponse(None, 400, {}, None), error
+
+        response = getattr(self, f"_{operation}")(self.clock.now(), **context["scripted_params"])
+        response.setdefault("ResponseMetadata", {"HTTPStatusCode": 200})
+        return AWSResponse(None, 200, {}, None), response
+
+    # STS
+    def _GetCallerIdentity(self, now, **params):
+        return {"Arn": "arn:aws:iam::123456789012:user/benchmark", "Account": "123456789012", "UserId": "AIDABENCHMARK"}
+
+    # CodeBuild
+    def _StartBuild(self, now, projectName, **params):
+        timeline = self.builds.get(projectName) or self.add_build(projectName)
+        return {"build": timeline.build(now)}
+
+    def _BatchGetBuilds(self, now, ids, **params):
+        by_id = {timeline.build_id: timeline for timeline in self.builds.values()}
+        for batch in self.build_batches.values():
+            by_id.update((child.build_id, child) for child in batch.children.values())
+        builds = []
+        for build_id in ids:
+            if build_id in by_id:
+                builds.append(by_id[build_id].build(now))
+            elif build_id.startswith("history:"):
+                project_name = build_id.split(":")[1]
+                builds.append(BuildTimeline(self.clock, project_name, now - 1000).build(now))
+        return {"builds": builds, "buildsNotFound": [build_id for build_id in ids if build_id not in by_id and not build_id.startswith("history:")]}
+
+    def _StartBuildBatch(self, now, projectName, **params):
+        timeline = self.build_batches.get(projectName) or self.add_build_batch(projectName, 1)
+        return {"buildBatch": timeline.build_batch(now)}
+
+    def _BatchGetBuildBatches(self, now, ids, **params):
+        by_id = {timeline.batch_id: timeline for timeline in self.build_batches.values()}
+        return {"buildBatches": [by_id[batch_id].build_batch(now) for batch_id in ids if batch_id in by_id]}
+
+    def _ListBuildsForProject(self, now, projectName, **params):
+        ids = [f"history:{projectName}:{n}" for n in range(5)] if self.history else []
+        return {"ids": ids}
+
+    # SQS
+    def _ReceiveMessage(self, now, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **params):
+        return {"Messages": self.queue.receive(MaxNumberOfMessages, WaitTimeSeconds)}
+
+    def _DeleteMessageBatch(self, now, QueueUrl, Entries, **params):
+        for entry in Entries:
+            self.queue.delete(entry["ReceiptHandle"])
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    def _ChangeMessageVisibilityBatch(self, now, QueueUrl, Entries, **params):
+        for entry in Entries:
+            self.queue.change_visibility(entry["ReceiptHandle"], entry["VisibilityTimeout"])
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    # CodeDeploy
+    def _GetDeployment(self, now, deploymentId, **params):
+        status = "Succeeded" if now >= self.deployment.finished_at() else "InProgress"
+        succeeded = sum(1 for n in range(len(self.deployment.instance_ids)) if now >= self.deployment.instance_finished_at(n))
+        overview = {"Pending": 0, "InProgress": len(self.deployment.instance_ids) - succeeded, "Succeeded": succeeded, "Failed": 0, "Skipped": 0, "Ready": 0}
+        return {"deploymentInfo": {"deploymentId": deploymentId, "status": status, "deploymentOverview": overview}}
+
+    def _ListDeployments(self, now, **params):
+        return {"deployments": ["d-HISTORY"] if self.history else []}
+
+    def _ListDeploymentTargets(self, now, deploymentId, nextToken=None, **params):
+        if deploymentId == "d-HISTORY":
+            return {"targetIds": self.deployment.instance_ids[:25]}
+        start = int(nextToken or 0)
+        response = {"targetIds": self.deployment.instance_ids[start:start + 100]}
+        if start + 100 < len(self.deployment.instance_ids):
+            response["nextToken"] = str(start + 100)
+        return response
+
+    def _BatchGetDeploymentTargets(self, now, deploymentId, targetIds, **params):
+        if deploymentId == "d-HISTORY":
+            now = self.deployment.finished_at() + now
+        index = {instance_id: n for n, instance_id in enumerate(self.deployment.instance_ids)}
+        return {"deploymentTargets": [self.deployment.target(index[target_id], now) for target_id in targetIds]}
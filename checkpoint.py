@@ -0,0 +1,60 @@
+import json
+import os
+import tempfile
+import threading
+
+DEFAULT_CHECKPOINT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "aws-updates-to-slack", "checkpoints")
+
+
+def default_checkpoint_path(*names) -> str:
+    """
+    Checkpoint file for a watcher, e.g. default_checkpoint_path('codebuild', project_name)
+    """
+    file_name = "-".join(name.replace("/", "_") for name in names if name)
+    return os.path.join(DEFAULT_CHECKPOINT_DIR, f"{file_name}.json")
+
+
+def watcher_checkpoint(args, *names):
+    """
+    Checkpoint of a watcher run, or None unless it was asked for with --checkpoint_path or --resume:
+    default paths are only keyed by project, so parallel runs of one project would overwrite each other's
+    """
+    if not args.checkpoint_path and not args.resume:
+        return None
+    return Checkpoint(args.checkpoint_path or default_checkpoint_path(*names))
+
+
+class Checkpoint(object):
+    """
+    Watcher state on disk, written atomically so a killed process
+    always leaves either the previous or the new checkpoint behind.
+    params:
+        - path(str): JSON file holding the checkpoint
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, state: dict) -> None:
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".")
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,118 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+
+from metrics import instrument_client
+from poll_cache import SharedPollCache, share_calls
+from retry import RetryingClient, aws_retrier
+
+
+def setup_client(args: argparse.Namespace, client, role_arn=""):
+    """
+    Instrument a boto3 client and, with --poll_cache_ttl, share its describe calls with other processes.
+    Returns the client with its calls going through the shared AWS retrier.
+    """
+    instrument_client(client)
+    if args.poll_cache_ttl:
+        share_calls(client, SharedPollCache(args.poll_cache_dir, ttl=args.poll_cache_ttl), scope=role_arn)
+    return RetryingClient(client, aws_retrier(client, role_arn))
+
+
+def load_targets(targets_json: str) -> list:
+    """
+    Parse --targets, failing on anything but a non-empty JSON list of objects with a "region"
+    """
+    targets = json.loads(targets_json)
+    if not isinstance(targets, list) or not targets:
+        raise ValueError(f"--targets must be a non-empty JSON list of targets, got {targets_json!r}")
+    for target in targets:
+        if not isinstance(target, dict) or not target.get("region"):
+            raise ValueError(f"every target in --targets needs a \"region\", got {target!r}")
+    return targets
+
+
+def watch_all(watch, jobs: list, what="targets") -> None:
+    """
+    Run every job on its own thread until all are done, then fail if any of them did,
+    so one failing target does not stop the others
+    params:
+        - watch(callable): called with the args of each job
+        - jobs(list): (label in logs, tuple of args of `watch`) for each job
+        - what(str): what the jobs watch, in the error
+    """
+    with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix='target') as executor:
+        futures = [(executor.submit(watch, *job_args), label) for label, job_args in jobs]
+    failed = []
+    for future, label in futures:
+        if future.exception() is not None:
+            print(f"watching {label} failed: {future.exception()!r}")
+            failed.append(label)
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(jobs)} {what} failed")
+
+
+class ClientPool(object):
+    """
+    boto3 clients shared by every target in the same account and region: one session per
+    role, whose assumed-role credentials refresh themselves before they expire, and one
+    client per (role, region, service), so the number of clients does not grow with the
+    number of targets. Safe to use from many threads.
+    params:
+        - setup(callable): called as setup(client, role_arn) on every new client, e.g. to instrument it
+        - session_name(str): RoleSessionName of the assumed roles, shows up in CloudTrail
+        - config(botocore.config.Config): config of every client, e.g. retry.aws_client_config()
+    """
+
+    def __init__(self, setup=None, session_name="aws-updates-to-slack", config=None):
+        self.setup = setup
+        self.session_name = session_name
+        self.config = config
+        self._sessions = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, service_name: str, region_name: str, role_arn="", endpoint_url=""):
+        """
+        params:
+            - role_arn(str): role to assume in the target account, "" for the default credentials
+            - endpoint_url(str): endpoint to call instead of AWS, e.g. a local SQS, "" for AWS
+        """
+        key = (role_arn, region_name, service_name, endpoint_url)
+        with self._lock:
+            if key not in self._clients:
+                # sessions are not thread-safe, so clients are only created under the lock
+                client = self._session(role_arn).client(service_name, region_name=region_name, endpoint_url=endpoint_url or None, config=self.config)
+                self._clients[key] = self.setup(client, role_arn) if self.setup else client
+            return self._clients[key]
+
+    def _session(self, role_arn: str):
+        if role_arn not in self._sessions:
+            self._sessions[role_arn] = self._assume_role(role_arn) if role_arn else self._default_session()
+        return self._sessions[role_arn]
+
+    @staticmethod
+    def _default_session():
+        import boto3
+
+        return boto3.Session()
+
+    def _assume_role(self, role_arn: str):
+        import boto3
+        import botocore.session
+        from botocore.credentials import AssumeRoleCredentialFetcher, DeferredRefreshableCredentials
+
+        source_session = botocore.session.get_session()
+        fetcher = AssumeRoleCredentialFetcher(
+            client_creator=source_session.create_client,
+            source_credentials=source_session.get_credentials(),
+            role_arn=role_arn,
+            extra_args={"RoleSessionName": self.session_name},
+        )
+        # assumes the role on first use and again shortly before the credentials expire
+        botocore_session = botocore.session.get_session()
+        botocore_session._credentials = DeferredRefreshableCredentials(
+            method="assume-role",
+            refresh_using=fetcher.fetch_credentials,
+        )
+        return boto3.Session(botocore_session=botocore_session)
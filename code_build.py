@@ -1,96 +1,140 @@
 import argparse
 from collections import OrderedDict
 from datetime import datetime
+import hashlib
 import json
 import time
 import urllib.parse
 
-import boto3
-
+from checkpoint import Checkpoint, default_checkpoint_path, watcher_checkpoint
+from client_pool import ClientPool, load_targets, setup_client, watch_all
+from event_source import BUILD_PHASE_CHANGE, SqsEventSource, build_id_from_event
+from log_tail import LogTail
+from metrics import Metrics, instrument_client
+from poll_cache import DEFAULT_POLL_CACHE_DIR
+from poll_scheduler import AdaptivePoller, DEFAULT_CACHE_PATH, PhaseDurationCache, learn_build_phase_durations
 from progress_bar import SlackProgress
+from retry import RetryingClient, aws_client_config, aws_retrier, classify, throttle_rate
+from startup import DEFAULT_STARTUP_CACHE_PATH, StartupProfiler, TTLCache, get_iam_identity
 
+# batch_get_builds accepts at most 100 ids per call
+BATCH_GET_BUILDS_MAX_IDS = 100
 
-def main(args: argparse.Namespace) -> None:
-    slack_token = args.slack_token
-    channel_name = args.channel_name
-    project_name = args.project_name
-    iam_slack_usernames_mapping = args.iam_slack_usernames_mapping
-    aws_region = args.aws_region
-
-    codebuild_client = boto3.client('codebuild')
-
-    iam_slack_usernames_mapping = json.loads(iam_slack_usernames_mapping)
-    sts_client = boto3.client('sts')
-    response = sts_client.get_caller_identity()
-    iam_username = response['Arn'].partition('/')[-1]
-    iam_account_id = response['Account']
-    if iam_slack_usernames_mapping.get(iam_username):
-        iam_username_log_message = f"<@{iam_slack_usernames_mapping[iam_username]}>"
-    else:
-        iam_username_log_message = f"'AWS User {iam_username}'"
-
-    build_response_data: dict = codebuild_client.start_build(
-        projectName=project_name,
-    )
-    build_id = build_response_data["build"]["id"]
-    build_status = build_response_data["build"]["buildStatus"]
-    build_phases = build_response_data["build"]["phases"]
-
-    # Create AWS CodeBuild Console URL
-    build_id_url_encoded = urllib.parse.quote_plus(build_id)
-    code_build_console_link = f"https://{aws_region}.console.aws.amazon.com/codesuite/codebuild/{iam_account_id}/projects/{project_name}/build/{build_id_url_encoded}/phase?region={aws_region}"
-
-    # Initialize Slack here
-    prefix = f"<{code_build_console_link}|*CodeBuild: {project_name}*>"
-    sp = SlackProgress(token=slack_token, channel=channel_name, prefix=prefix)
-    current_percentage_int = 0
-
-    build_phases_updated_in_slack_mapping = OrderedDict()
-    for _start_build_phase in build_phases:
-        build_phases_updated_in_slack_mapping[_start_build_phase["phaseType"]] = False
-
-    # Initialize Slack ProgressBar here
-    pbar = sp.new()
-    log_message = f"Build: *{project_name}*, BuildStatus=`{build_status}`, Initiated by: {iam_username_log_message}"
-    pbar.pos = current_percentage_int
-    pbar.log(log_message)
-
-    is_build_running = True
-    while is_build_running:
-        print(f"Sleeping for 5 sec... {datetime.now()}")
-        time.sleep(5)
 
+def batch_get_builds(codebuild_client, build_ids: list) -> dict:
+    """
+    Fetch many builds with as few batch_get_builds calls as possible
+    params:
+        - build_ids(list): build ids, any number
+    returns: dict of build id -> build
+    """
+    builds = {}
+    for i in range(0, len(build_ids), BATCH_GET_BUILDS_MAX_IDS):
         build_response_data: dict = codebuild_client.batch_get_builds(
-            ids=[build_id]
+            ids=build_ids[i:i + BATCH_GET_BUILDS_MAX_IDS]
         )
+        for build in build_response_data["builds"]:
+            builds[build["id"]] = build
+    return builds
+
+
+class BuildTracker(object):
+    """
+    Drives one SlackProgress bar from successive snapshots of one build
+    """
+
+    def __init__(self, build: dict, slack_token: str, channel_name: str, aws_region: str, iam_account_id: str, iam_username_log_message: str, poller: AdaptivePoller, state=None, logs_client=None, tail_lines=0):
+        self.poller = poller
+        self.logs_client = logs_client
+        self.tail_lines = tail_lines
+        self.log_tail = None
+        self.build_id = build["id"]
+        self.project_name = build["projectName"]
+        self.build_status = build["buildStatus"]
+        self.iam_username_log_message = iam_username_log_message
+        self.current_build_phases = build.get("phases", [])
+        self.current_percentage_int = 0
+
+        # Create AWS CodeBuild Console URL, in the account the build runs in
+        account_id = build["arn"].split(":")[4] if build.get("arn") else iam_account_id
+        build_id_url_encoded = urllib.parse.quote_plus(self.build_id)
+        code_build_console_link = f"https://{aws_region}.console.aws.amazon.com/codesuite/codebuild/{account_id}/projects/{self.project_name}/build/{build_id_url_encoded}/phase?region={aws_region}"
+
+        # Initialize Slack here
+        self.prefix = f"<{code_build_console_link}|*CodeBuild: {self.project_name}*>"
+        sp = SlackProgress(token=slack_token, channel=channel_name, prefix=self.prefix)
+
+        if state:
+            # Resume the Slack ProgressBar of a previous run, without posting
+            self.pbar = sp.restore(state["pbar"])
+            self.current_percentage_int = state["current_percentage_int"]
+            self.build_phases_updated_in_slack_mapping = OrderedDict(state["build_phases_updated_in_slack_mapping"])
+            if logs_client and state.get("log_tail"):
+                log_tail_state = state["log_tail"]
+                self.log_tail = LogTail(logs_client, log_tail_state["group_name"], log_tail_state["stream_name"], max_lines=tail_lines, state=log_tail_state)
+            return
+
+        self.build_phases_updated_in_slack_mapping = OrderedDict()
+        for _start_build_phase in self.current_build_phases:
+            self.build_phases_updated_in_slack_mapping[_start_build_phase["phaseType"]] = False
+
+        # Initialize Slack ProgressBar here
+        self.pbar = sp.new()
+        log_message = f"Build: *{self.project_name}*, BuildStatus=`{self.build_status}`, Initiated by: {iam_username_log_message}"
+        self.pbar.pos = self.current_percentage_int
+        self.pbar.log(log_message)
+
+    @property
+    def is_build_running(self) -> bool:
+        return self.build_status == 'IN_PROGRESS'
 
-        build_status = build_response_data["builds"][0]["buildStatus"]
-        if build_status != 'IN_PROGRESS':
-            # break here and update slack finally.
-            is_build_running = False
-            log_message = f"Build: *{project_name}*, BuildStatus=`{build_status}`"
-            if build_status == 'SUCCEEDED':
+    def next_poll_interval(self, throttle_rate=0.0) -> float:
+        in_progress = [(p["phaseType"], p.get("startTime")) for p in self.current_build_phases if not p.get("endTime")]
+        return self.poller.next_interval(in_progress, throttle_rate)
+
+    def state(self) -> dict:
+        """
+        JSON-serialisable state for resuming this tracker
+        """
+        return {
+            "current_percentage_int": self.current_percentage_int,
+            "build_phases_updated_in_slack_mapping": list(self.build_phases_updated_in_slack_mapping.items()),
+            "pbar": self.pbar.state(),
+            "log_tail": self.log_tail.state() if self.log_tail else None,
+        }
+
+    def update(self, build: dict) -> None:
+        """
+        Push the phases that changed since the last snapshot to Slack
+        """
+        self._tail_logs(build)
+        self.build_status = build["buildStatus"]
+        if self.build_status != 'IN_PROGRESS':
+            # update slack finally.
+            log_message = f"Build: *{self.project_name}*, BuildStatus=`{self.build_status}`"
+            if self.build_status == 'SUCCEEDED':
                 log_message_emoji = ":large_blue_circle:"
             else:
                 log_message_emoji = ":red_circle:"
             log_message += log_message_emoji
-            pbar.pos = 100
-            pbar.log(log_message)
-            break
+            self.pbar.pos = 100
+            self.pbar.log(log_message)
+            self.finish()
+            return
 
-        current_build_phases = build_response_data["builds"][0]["phases"]
-        for _cbp in current_build_phases:
-            if _cbp["phaseType"] not in build_phases_updated_in_slack_mapping:
-                build_phases_updated_in_slack_mapping[_cbp["phaseType"]] = False
+        self.current_build_phases = build["phases"]
+        for _cbp in self.current_build_phases:
+            if _cbp["phaseType"] not in self.build_phases_updated_in_slack_mapping:
+                self.build_phases_updated_in_slack_mapping[_cbp["phaseType"]] = False
 
-        for _, (_build_phase, _is_build_phase_updated_in_slack) in enumerate(list(build_phases_updated_in_slack_mapping.items()), start=1):
+        for _, (_build_phase, _is_build_phase_updated_in_slack) in enumerate(list(self.build_phases_updated_in_slack_mapping.items()), start=1):
             if _is_build_phase_updated_in_slack:
                 continue
 
             print(f"updating {_build_phase} in slack...")
             build_phase_found = False
             phases_found = []
-            for current_build_phase in current_build_phases:
+            for current_build_phase in self.current_build_phases:
                 phaseType = current_build_phase["phaseType"]
                 phases_found.append(phaseType)
 
@@ -108,25 +152,529 @@ def main(args: argparse.Namespace) -> None:
                 print(f"ughh, Build Phase {_build_phase} has no status yet.")
                 break
 
-            phase_type, phase_status = current_build_phase["phaseType"], current_build_phase["phaseStatus"]
-            log_message = f"Build's Phase: {phase_type}, PhaseStatus=*{phase_status}*"
-            current_percentage_int += 100/11
-            current_percentage_int = round(current_percentage_int, 1)
-            pbar.pos = current_percentage_int
-            pbar.log(log_message)
-            build_phases_updated_in_slack_mapping[_build_phase] = True
-
-    build_phases_contexts = ""
-    for current_build_phase in current_build_phases:
-        if not current_build_phase.get("contexts"):
+            self._log_phase(current_build_phase["phaseType"], current_build_phase["phaseStatus"])
+
+    def apply_phase_event(self, detail: dict) -> None:
+        """
+        Push a phase straight from a "CodeBuild Build Phase Change" event
+        """
+        phase_type = detail["completed-phase"]
+        if self.build_phases_updated_in_slack_mapping.get(phase_type):
+            return
+        self._log_phase(phase_type, detail["completed-phase-status"])
+
+    def _tail_logs(self, build: dict) -> None:
+        if not self.logs_client or not self.tail_lines:
+            return
+        logs = build.get("logs", {})
+        if self.log_tail is None and logs.get("groupName") and logs.get("streamName"):
+            self.log_tail = LogTail(self.logs_client, logs["groupName"], logs["streamName"], max_lines=self.tail_lines)
+        if not self.log_tail:
+            return
+        try:
+            self.log_tail.poll()
+        except Exception as err:
+            # the tail is optional, it must not stop the Slack updates of this build or the others
+            print(f"tailing logs of {self.build_id} failed, not tailing them anymore: {err!r}")
+            self.tail_lines = 0
+
+    def _log_phase(self, phase_type: str, phase_status: str) -> None:
+        log_message = f"Build's Phase: {phase_type}, PhaseStatus=*{phase_status}*"
+        self.current_percentage_int += self.poller.share(phase_type)
+        self.current_percentage_int = round(self.current_percentage_int, 1)
+        self.pbar.pos = self.current_percentage_int
+        self.pbar.log(log_message)
+        self.build_phases_updated_in_slack_mapping[phase_type] = True
+
+    def finish(self) -> None:
+        build_phases_contexts = ""
+        for current_build_phase in self.current_build_phases:
+            if not current_build_phase.get("contexts"):
+                continue
+
+            for context in current_build_phase.get("contexts"):
+                if context.get("message"):
+                    build_phases_contexts += f"\n\nBuild's Phase: *{current_build_phase['phaseType']}* Context: `{context.get('message')}`."
+
+        log_message = f"{self.prefix} *{self.build_status}!* {self.iam_username_log_message} {build_phases_contexts}"
+        self.pbar.log_thread(log_message)
+
+        if self.build_status != 'SUCCEEDED' and self.log_tail and self.log_tail.lines:
+            # a ``` inside the logs would close the code block early
+            log_lines = "\n".join(self.log_tail.lines).replace("```", "` ` `")
+            self.pbar.log_thread(f"Last {len(self.log_tail.lines)} log lines:\n```{log_lines}```")
+
+
+def child_build_ids(build_batch: dict) -> dict:
+    """
+    Current build of every build group of a batch build that has started one
+    returns: dict of build group identifier -> build id
+    """
+    children = OrderedDict()
+    for build_group in build_batch.get("buildGroups", []):
+        arn = build_group.get("currentBuildSummary", {}).get("arn")
+        if arn:
+            # arn:aws:codebuild:<region>:<account>:build/<project>:<uuid>
+            children[build_group["identifier"]] = arn.partition(":build/")[2]
+    return children
+
+
+class BatchTracker(object):
+    """
+    Drives one SlackProgress bar from successive snapshots of a batch build and its child builds.
+    The bar shows overall progress with one compact line per child rewritten in place,
+    and a log line whenever a child finishes, so a tick costs one message edit however
+    many children changed.
+    """
+
+    def __init__(self, build_batch: dict, slack_token: str, channel_name: str, aws_region: str, iam_account_id: str, iam_username_log_message: str, poller: AdaptivePoller, state=None):
+        self.poller = poller
+        self.batch_id = build_batch["id"]
+        self.project_name = build_batch["projectName"]
+        self.batch_status = build_batch["buildBatchStatus"]
+        self.iam_username_log_message = iam_username_log_message
+        self.group_identifiers = [build_group["identifier"] for build_group in build_batch.get("buildGroups", [])]
+        self.children = OrderedDict()
+        self.child_builds = {}
+        self.finished_children = OrderedDict()
+
+        # Create AWS CodeBuild Console URL
+        batch_id_url_encoded = urllib.parse.quote_plus(self.batch_id)
+        code_build_console_link = f"https://{aws_region}.console.aws.amazon.com/codesuite/codebuild/{iam_account_id}/projects/{self.project_name}/batch/{batch_id_url_encoded}?region={aws_region}"
+
+        # Initialize Slack here
+        self.prefix = f"<{code_build_console_link}|*CodeBuild batch: {self.project_name}*>"
+        sp = SlackProgress(token=slack_token, channel=channel_name, prefix=self.prefix)
+
+        if state:
+            # Resume the Slack ProgressBar of a previous run, without posting
+            self.pbar = sp.restore(state["pbar"])
+            self.finished_children = OrderedDict(state["finished_children"])
+            return
+
+        # Initialize Slack ProgressBar here
+        self.pbar = sp.new()
+        log_message = f"Build batch: *{self.project_name}*, BuildBatchStatus=`{self.batch_status}`, Initiated by: {iam_username_log_message}"
+        self.pbar.log(log_message)
+
+    @property
+    def is_batch_running(self) -> bool:
+        return self.batch_status == 'IN_PROGRESS'
+
+    def running_child_ids(self) -> list:
+        return [build_id for identifier, build_id in self.children.items() if identifier not in self.finished_children]
+
+    def next_poll_interval(self, throttle_rate=0.0) -> float:
+        in_progress = [
+            (phase["phaseType"], phase.get("startTime"))
+            for build_id in self.running_child_ids()
+            for phase in self.child_builds.get(build_id, {}).get("phases", [])
+            if not phase.get("endTime")
+        ]
+        return self.poller.next_interval(in_progress, throttle_rate)
+
+    def state(self) -> dict:
+        """
+        JSON-serialisable state for resuming this tracker
+        """
+        return {
+            "finished_children": list(self.finished_children.items()),
+            "pbar": self.pbar.state(),
+        }
+
+    def update(self, build_batch: dict, builds: dict) -> None:
+        """
+        Apply a batch_get_build_batches snapshot and the batch_get_builds snapshots of its children
+        """
+        self.batch_status = build_batch["buildBatchStatus"]
+        self.group_identifiers = [build_group["identifier"] for build_group in build_batch.get("buildGroups", [])] or self.group_identifiers
+        self.children = child_build_ids(build_batch)
+        self.child_builds.update(builds)
+
+        lines = []
+        progress = 0
+        for identifier in self.group_identifiers:
+            build = self.child_builds.get(self.children.get(identifier), {})
+            build_status = build.get("buildStatus")
+            if build_status and build_status != 'IN_PROGRESS' and identifier not in self.finished_children:
+                self.finished_children[identifier] = build_status
+                log_message_emoji = ":large_blue_circle:" if build_status == 'SUCCEEDED' else ":red_circle:"
+                self.pbar.log(f"Build: *{identifier}*, BuildStatus=`{build_status}`{log_message_emoji}")
+
+            child_progress = self._child_progress(build)
+            progress += child_progress
+            if identifier in self.finished_children:
+                lines.append(f"`{identifier}` {self.finished_children[identifier]}")
+            elif build:
+                current_phase = build.get("currentPhase") or build_status
+                lines.append(f"`{identifier}` {child_progress:.0f}% {current_phase}")
+            else:
+                lines.append(f"`{identifier}` waiting")
+
+        self.pbar.status = "\n".join(lines)
+        if self.group_identifiers:
+            self.pbar.pos = round(progress / len(self.group_identifiers), 1)
+
+        if not self.is_batch_running:
+            # update slack finally.
+            log_message_emoji = ":large_blue_circle:" if self.batch_status == 'SUCCEEDED' else ":red_circle:"
+            self.pbar.pos = 100
+            self.pbar.log(f"Build batch: *{self.project_name}*, BuildBatchStatus=`{self.batch_status}`{log_message_emoji}")
+            self.finish()
+
+    def _child_progress(self, build: dict) -> float:
+        if not build:
+            return 0
+        if build["buildStatus"] != 'IN_PROGRESS':
+            return 100
+        return min(100, sum(self.poller.share(phase["phaseType"]) for phase in build.get("phases", []) if phase.get("endTime")))
+
+    def finish(self) -> None:
+        failed = [f"`{identifier}` {build_status}" for identifier, build_status in self.finished_children.items() if build_status != 'SUCCEEDED']
+        log_message = f"{self.prefix} *{self.batch_status}!* {self.iam_username_log_message}"
+        if failed:
+            log_message += "\nFailed builds: " + ", ".join(failed)
+        self.pbar.log_thread(log_message)
+
+
+def save_checkpoint(checkpoint: Checkpoint, trackers: dict) -> None:
+    """
+    Flush every bar without waiting on Slack, and record what Slack shows
+    now and again as each bar's edit lands, so a restarted watcher can
+    resume without re-posting
+    """
+    if not trackers:
+        checkpoint.clear()
+        return
+
+    def save(_future=None):
+        # edits land on the transport thread, after the poll may have moved on
+        snapshot = list(trackers.items())
+        if snapshot:
+            checkpoint.save({"builds": {build_id: tracker.state() for build_id, tracker in snapshot}})
+
+    for tracker in list(trackers.values()):
+        future = tracker.pbar.flush(wait=False)
+        if future is not None:
+            future.add_done_callback(save)
+    save()
+
+
+def save_batch_checkpoint(checkpoint: Checkpoint, tracker: BatchTracker) -> None:
+    """
+    Flush the batch's bar without waiting on Slack, and record what Slack shows
+    now and again once the edit lands, as `save_checkpoint` does for builds
+    """
+    def save(_future=None):
+        # once the batch is done the checkpoint is cleared, a late edit must not bring it back
+        if tracker.is_batch_running:
+            checkpoint.save({"batch": {"id": tracker.batch_id, "tracker": tracker.state()}})
+
+    future = tracker.pbar.flush(wait=False)
+    if future is not None:
+        future.add_done_callback(save)
+    save()
+
+
+def poll_builds(codebuild_client, trackers: dict, event_source=None, reconcile_interval=60, checkpoint=None) -> None:
+    """
+    Update every tracker until its build stops running.
+    Without an event source builds are polled on the adaptive interval; with one,
+    phase-change events are applied as they arrive and batch_get_builds is only
+    called on build state changes or every `reconcile_interval` sec to catch missed events.
+    """
+    metrics = Metrics.shared()
+    last_reconcile = time.monotonic()
+    finished_build_ids = set()
+    while trackers:
+        iteration_started_at = time.perf_counter()
+        if checkpoint:
+            save_checkpoint(checkpoint, trackers)
+
+        wait_started_at = time.perf_counter()
+        if event_source:
+            timeout = max(0, last_reconcile + reconcile_interval - time.monotonic())
+            events = event_source.wait(
+                timeout,
+                accept=lambda event: build_id_from_event(event) in trackers,
+                drop=lambda event: build_id_from_event(event) in finished_build_ids,
+            )
+            waited = time.perf_counter() - wait_started_at
+            reconcile = not events
+            for event in events:
+                tracker = trackers[build_id_from_event(event)]
+                if event["detail-type"] == BUILD_PHASE_CHANGE:
+                    print(f"event: {event['detail-type']} for {tracker.build_id}")
+                    tracker.apply_phase_event(event["detail"])
+                else:
+                    reconcile = True
+            if not reconcile:
+                metrics.observe("loop_iteration_seconds", time.perf_counter() - iteration_started_at - waited, watcher="codebuild")
+                continue
+        else:
+            poll_interval = min(tracker.next_poll_interval(throttle_rate(codebuild_client)) for tracker in trackers.values())
+            print(f"Sleeping for {poll_interval:.1f} sec... watching {len(trackers)} builds {datetime.now()}")
+            time.sleep(poll_interval)
+            waited = time.perf_counter() - wait_started_at
+
+        last_reconcile = time.monotonic()
+        try:
+            builds = batch_get_builds(codebuild_client, list(trackers))
+        except Exception as err:
+            if classify(err)[0] != 'throttle':
+                raise
+            print(f"still throttled, skipping this poll: {err!r}")
             continue
+        for build_id, build in builds.items():
+            tracker = trackers[build_id]
+            tracker.update(build)
+            if not tracker.is_build_running:
+                del trackers[build_id]
+                finished_build_ids.add(build_id)
+        # time spent working rather than waiting for the next poll
+        metrics.observe("loop_iteration_seconds", time.perf_counter() - iteration_started_at - waited, watcher="codebuild")
 
-        for context in current_build_phase.get("contexts"):
-            if context.get("message"):
-                build_phases_contexts += f"\n\nBuild's Phase: *{current_build_phase['phaseType']}* Context: `{context.get('message')}`."
+    if checkpoint:
+        checkpoint.clear()
 
-    log_message = f"{prefix} *{build_status}!* {iam_username_log_message} {build_phases_contexts}"
-    pbar.log_thread(log_message)
+
+def get_codebuild_client(args: argparse.Namespace):
+    import boto3
+
+    return setup_client(args, boto3.client('codebuild', config=aws_client_config()))
+
+
+def get_event_source(args: argparse.Namespace):
+    if not args.sqs_queue_url:
+        return None
+    import boto3
+
+    sqs_client = instrument_client(boto3.client('sqs', endpoint_url=args.sqs_endpoint_url or None))
+    return SqsEventSource(sqs_client, args.sqs_queue_url)
+
+
+def track_builds(args: argparse.Namespace, codebuild_client, builds: list, checkpoint: Checkpoint, profiler: StartupProfiler, states=None, logs_client=None) -> None:
+    """
+    Create a tracker per build, resuming the ones found in `states`, and poll them all
+    """
+    with profiler.step("sts get_caller_identity"):
+        iam_slack_usernames_mapping = json.loads(args.iam_slack_usernames_mapping)
+        iam_username_log_message, _, iam_account_id = get_iam_identity(iam_slack_usernames_mapping, TTLCache(args.startup_cache))
+    states = states or {}
+
+    cache = PhaseDurationCache(args.phase_durations_cache)
+    pollers = {}
+    with profiler.step("learn phase durations"):
+        for project_name in set(build["projectName"] for build in builds):
+            durations = learn_build_phase_durations(codebuild_client, project_name, cache)
+            pollers[project_name] = AdaptivePoller(durations, phase_count=11)
+
+    if args.tail_logs and logs_client is None:
+        import boto3
+
+        logs_client = instrument_client(boto3.client('logs', config=aws_client_config()))
+        logs_client = RetryingClient(logs_client, aws_retrier(logs_client))
+
+    trackers = {}
+    with profiler.step("post slack progress bars"):
+        for build in builds:
+            state = states.get(build["id"])
+            tracker = BuildTracker(build, args.slack_token, args.channel_name, args.aws_region, iam_account_id, iam_username_log_message, pollers[build["projectName"]], state=state, logs_client=logs_client, tail_lines=args.tail_logs)
+            if state or not tracker.is_build_running:
+                # catch up on everything that happened while no one was watching
+                tracker.update(build)
+            if tracker.is_build_running:
+                trackers[tracker.build_id] = tracker
+    profiler.report()
+
+    poll_builds(codebuild_client, trackers, get_event_source(args), args.reconcile_interval, checkpoint)
+
+
+def resume_builds(codebuild_client, checkpoint: Checkpoint):
+    """
+    returns: (builds, tracker states) from the checkpoint, or None if there is nothing to resume
+    """
+    saved = checkpoint.load()
+    if not saved or not saved.get("builds"):
+        return None
+    print(f"resuming {len(saved['builds'])} builds from {checkpoint.path}...")
+    builds = list(batch_get_builds(codebuild_client, list(saved["builds"])).values())
+    return builds, saved["builds"]
+
+
+def main(args: argparse.Namespace) -> None:
+    project_name = args.project_name
+    profiler = StartupProfiler(args.profile_startup)
+    Metrics.shared().export_at_exit(args.metrics_path)
+
+    with profiler.step("import boto3"):
+        codebuild_client = get_codebuild_client(args)
+    checkpoint = watcher_checkpoint(args, 'codebuild', project_name)
+
+    resumed = resume_builds(codebuild_client, checkpoint) if args.resume else None
+    if resumed:
+        builds, states = resumed
+        track_builds(args, codebuild_client, builds, checkpoint, profiler, states)
+        return
+
+    with profiler.step("start_build"):
+        build_response_data: dict = codebuild_client.start_build(
+            projectName=project_name,
+        )
+    track_builds(args, codebuild_client, [build_response_data["build"]], checkpoint, profiler)
+
+
+def watch(args: argparse.Namespace) -> None:
+    """
+    Watch many builds from one process: start a build for every project in
+    `--project_names`, add the builds in `--build_ids`, then poll all of them
+    with one chunked batch_get_builds call per tick.
+    """
+    profiler = StartupProfiler(args.profile_startup)
+    Metrics.shared().export_at_exit(args.metrics_path)
+
+    with profiler.step("import boto3"):
+        codebuild_client = get_codebuild_client(args)
+    watch_key = hashlib.sha1(" ".join(args.project_names + args.build_ids).encode()).hexdigest()[:12]
+    checkpoint = watcher_checkpoint(args, 'codebuild', 'watch', watch_key)
+
+    resumed = resume_builds(codebuild_client, checkpoint) if args.resume else None
+    if resumed:
+        builds, states = resumed
+        track_builds(args, codebuild_client, builds, checkpoint, profiler, states)
+        return
+
+    builds = []
+    with profiler.step("start_build"):
+        for project_name in args.project_names:
+            build_response_data: dict = codebuild_client.start_build(
+                projectName=project_name,
+            )
+            builds.append(build_response_data["build"])
+        if args.build_ids:
+            builds.extend(batch_get_builds(codebuild_client, args.build_ids).values())
+
+    track_builds(args, codebuild_client, builds, checkpoint, profiler)
+
+
+def watch_batch(args: argparse.Namespace) -> None:
+    """
+    Start a batch build (build matrix/fan-out) of `--project_name` and follow it:
+    one batch_get_build_batches call and chunked batch_get_builds calls for the
+    running children per tick, merged into one Slack edit.
+    """
+    project_name = args.project_name
+    profiler = StartupProfiler(args.profile_startup)
+    Metrics.shared().export_at_exit(args.metrics_path)
+
+    with profiler.step("import boto3"):
+        codebuild_client = get_codebuild_client(args)
+    checkpoint = watcher_checkpoint(args, 'codebuild', 'batch', project_name)
+
+    saved = checkpoint.load() if args.resume else None
+    if saved and saved.get("batch"):
+        print(f"resuming from {checkpoint.path}...")
+        batch_id = saved["batch"]["id"]
+        build_batch = codebuild_client.batch_get_build_batches(ids=[batch_id])["buildBatches"][0]
+    else:
+        saved = None
+        with profiler.step("start_build_batch"):
+            build_batch = codebuild_client.start_build_batch(projectName=project_name)["buildBatch"]
+
+    with profiler.step("sts get_caller_identity"):
+        iam_slack_usernames_mapping = json.loads(args.iam_slack_usernames_mapping)
+        iam_username_log_message, _, iam_account_id = get_iam_identity(iam_slack_usernames_mapping, TTLCache(args.startup_cache))
+
+    with profiler.step("learn phase durations"):
+        durations = learn_build_phase_durations(codebuild_client, project_name, PhaseDurationCache(args.phase_durations_cache))
+    poller = AdaptivePoller(durations, phase_count=11)
+
+    with profiler.step("post slack progress bar"):
+        tracker = BatchTracker(build_batch, args.slack_token, args.channel_name, args.aws_region, iam_account_id, iam_username_log_message, poller, state=saved and saved["batch"]["tracker"])
+    profiler.report()
+
+    metrics = Metrics.shared()
+    while True:
+        iteration_started_at = time.perf_counter()
+        # finished children never change again, only the others are fetched
+        child_ids = [build_id for identifier, build_id in child_build_ids(build_batch).items() if identifier not in tracker.finished_children]
+        try:
+            builds = batch_get_builds(codebuild_client, child_ids)
+        except Exception as err:
+            if classify(err)[0] != 'throttle':
+                raise
+            print(f"still throttled, skipping this poll: {err!r}")
+        else:
+            tracker.update(build_batch, builds)
+            if not tracker.is_batch_running:
+                break
+
+            # one edit per tick, then record what Slack shows
+            if checkpoint:
+                save_batch_checkpoint(checkpoint, tracker)
+            else:
+                tracker.pbar.flush(wait=False)
+            metrics.observe("loop_iteration_seconds", time.perf_counter() - iteration_started_at, watcher="codebuild_batch")
+
+        poll_interval = tracker.next_poll_interval(throttle_rate(codebuild_client))
+        print(f"Sleeping for {poll_interval:.1f} sec... watching {len(tracker.running_child_ids())} child builds {datetime.now()}")
+        time.sleep(poll_interval)
+        try:
+            build_batch = codebuild_client.batch_get_build_batches(ids=[tracker.batch_id])["buildBatches"][0]
+        except Exception as err:
+            if classify(err)[0] != 'throttle':
+                raise
+            # the children are polled again on the last known batch
+            print(f"still throttled, skipping this poll: {err!r}")
+
+    if checkpoint:
+        checkpoint.clear()
+
+
+def watch_targets(args: argparse.Namespace) -> None:
+    """
+    Watch builds in many regions and accounts from one process. `--targets` is a JSON
+    list of {"region", "role_arn", "project_name"} to start a build or {"region", "role_arn",
+    "build_id"} to follow one. Targets in the same account and region share one pooled
+    client and one batch_get_builds loop, and each loop runs on its own thread.
+    """
+    targets = load_targets(args.targets)
+    Metrics.shared().export_at_exit(args.metrics_path)
+    # one STS call for the caller's identity, rather than one from every target thread at once
+    get_iam_identity(json.loads(args.iam_slack_usernames_mapping), TTLCache(args.startup_cache))
+    pool = ClientPool(setup=lambda client, role_arn: setup_client(args, client, role_arn), config=aws_client_config())
+    groups = OrderedDict()
+    for target in targets:
+        groups.setdefault((target.get("role_arn", ""), target["region"]), []).append(target)
+
+    def watch_group(role_arn: str, region: str, targets: list) -> None:
+        profiler = StartupProfiler(args.profile_startup)
+        codebuild_client = pool.client('codebuild', region, role_arn)
+        group_args = argparse.Namespace(**vars(args))
+        group_args.aws_region = region
+        group_args.sqs_queue_url = ""
+
+        names = [target.get("project_name") or target["build_id"] for target in targets]
+        account_id = role_arn.split(":")[4] if role_arn else ""
+        group_key = hashlib.sha1(" ".join(names).encode()).hexdigest()[:12]
+        checkpoint = Checkpoint(default_checkpoint_path('codebuild', 'targets', region, account_id, group_key)) if args.resume or args.checkpoint_path else None
+
+        resumed = resume_builds(codebuild_client, checkpoint) if args.resume else None
+        if resumed:
+            builds, states = resumed
+        else:
+            builds, states = [], None
+            for target in targets:
+                if target.get("project_name"):
+                    builds.append(codebuild_client.start_build(projectName=target["project_name"])["build"])
+            build_ids = [target["build_id"] for target in targets if target.get("build_id")]
+            if build_ids:
+                builds.extend(batch_get_builds(codebuild_client, build_ids).values())
+
+        logs_client = pool.client('logs', region, role_arn) if args.tail_logs else None
+        track_builds(group_args, codebuild_client, builds, checkpoint, profiler, states, logs_client=logs_client)
+
+    watch_all(watch_group, [(f"builds in {region}", (role_arn, region, targets)) for (role_arn, region), targets in groups.items()], what="target groups")
 
 
 if __name__ == "__main__":
@@ -139,6 +687,41 @@ if __name__ == "__main__":
     parser.add_argument('--project_name', type=str)
     parser.add_argument('--iam_slack_usernames_mapping', default="{}", type=str)
     parser.add_argument('--aws_region', type=str)
+    parser.add_argument('--phase_durations_cache', default=DEFAULT_CACHE_PATH, type=str)
+    parser.add_argument('--startup_cache', default=DEFAULT_STARTUP_CACHE_PATH, type=str)
+    parser.add_argument('--profile_startup', action='store_true')
+    parser.add_argument('--metrics_path', default="", type=str, help="write metrics at exit, Prometheus textfile if it ends in .prom, JSON otherwise")
+    parser.add_argument('--tail_logs', default=0, type=int, help="tail the build's CloudWatch logs and post the last N lines when it fails")
+
+    # checkpoint/resume: pick up a killed run without re-posting
+    parser.add_argument('--resume', action='store_true', help="checkpoint every tick, and resume from the checkpoint of a killed run")
+    parser.add_argument('--checkpoint_path', default="", type=str, help="checkpoint every tick to this file, give parallel runs of one project different files")
+
+    # event-driven mode: EventBridge -> SQS, polling only to reconcile
+    parser.add_argument('--sqs_queue_url', default="", type=str)
+    parser.add_argument('--sqs_endpoint_url', default="", type=str)
+    parser.add_argument('--reconcile_interval', default=60, type=int)
+
+    # share describe calls with watchers of the same builds in other processes
+    parser.add_argument('--poll_cache_ttl', default=0, type=float, help="seconds a response is shared with other processes, 0 to disable")
+    parser.add_argument('--poll_cache_dir', default=DEFAULT_POLL_CACHE_DIR, type=str)
+
+    # multi-region/multi-account: many targets, one process, pooled clients
+    parser.add_argument('--targets', default="", type=str, help='JSON list of {"region", "role_arn", "project_name" or "build_id"}')
+
+    # batch builds: start_build_batch of --project_name
+    parser.add_argument('--batch', action='store_true')
+
+    # watcher mode: many builds, one process
+    parser.add_argument('--project_names', nargs='*', default=[], type=str)
+    parser.add_argument('--build_ids', nargs='*', default=[], type=str)
     args = parser.parse_args()
 
-    main(args=args)
+    if args.targets:
+        watch_targets(args=args)
+    elif args.batch:
+        watch_batch(args=args)
+    elif args.project_names or args.build_ids:
+        watch(args=args)
+    else:
+        main(args=args)
@@ -1,16 +1,74 @@
 import argparse
-from collections import OrderedDict
 from datetime import datetime
 import json
 import time
-import subprocess
 
-import boto3
-
-from progress_bar import SlackProgress
-
-
-def main(args: argparse.Namespace) -> None:
+from checkpoint import default_checkpoint_path, watcher_checkpoint
+from client_pool import ClientPool, load_targets, setup_client, watch_all
+from deploy_diff import LifecycleDiff, format_fleet_summary
+from deploy_targets import DeploymentTargetFetcher, deployment_target_count, list_deployment_target_ids
+from event_source import SqsEventSource, deployment_id_from_event
+from metrics import Metrics, instrument_client
+from poll_cache import DEFAULT_POLL_CACHE_DIR
+from poll_scheduler import AdaptivePoller, DEFAULT_CACHE_PATH, PhaseDurationCache, learn_deploy_event_durations
+from retry import aws_client_config, classify, throttle_rate
+from sinks import DeploySink, publish
+from startup import DEFAULT_STARTUP_CACHE_PATH, StartupProfiler, TTLCache, get_iam_identity, resolve_commit_id
+
+# a new deployment has no targets until CodeDeploy has started it, which can take a while behind others
+READY_POLL_INTERVAL = 5
+READY_TIMEOUT = 60 * 60
+
+
+def wait_for_target_ids(codedeploy_client, deployment_id: str, timeout=READY_TIMEOUT) -> list:
+    """
+    Target ids of a deployment, waiting every READY_POLL_INTERVAL sec while CodeDeploy has not started it.
+    Throttling and transient errors are retried by the client itself.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return list_deployment_target_ids(codedeploy_client, deployment_id)
+        except Exception as err:
+            if classify(err)[0] != 'not_ready' or time.monotonic() >= deadline:
+                raise
+            print(err)
+            print(f"deployment not ready, sleeping for {READY_POLL_INTERVAL} sec")
+            time.sleep(READY_POLL_INTERVAL)
+
+
+def lifecycle_event(transition) -> dict:
+    return {
+        "instance_id": transition.instance_id,
+        "lifecycle_event_name": transition.lifecycle_event_name,
+        "status": transition.status,
+        "instance_label": transition.instance_label,
+    }
+
+
+def bar_percentage(percentage: float) -> float:
+    """
+    The running percentage as shown on the bar: one decimal, at most 100
+    """
+    return min(100, round(percentage, 1))
+
+
+def publish_fleet_summary(sinks: list, lifecycle_diff: LifecycleDiff, failures: list, percentage: float) -> None:
+    """
+    One summary per tick and at most one thread post for its failures, whatever the fleet size
+    """
+    summary = format_fleet_summary(lifecycle_diff.summary(), len(lifecycle_diff.instance_ids))
+    publish(sinks, {"type": "summary", "summary": summary, "percentage": percentage})
+    if failures:
+        publish(sinks, {"type": "failures", "failures": failures})
+
+
+def main(args: argparse.Namespace, codedeploy_client=None, sqs_client=None) -> None:
+    """
+    params:
+        - codedeploy_client: client to watch the deployment with, one for the default session and region if None
+        - sqs_client: client to read --sqs_queue_url with, one for the default session if None
+    """
     slack_token = args.slack_token
     channel_name = args.channel_name
     project_name = args.project_name
@@ -23,23 +81,34 @@ def main(args: argparse.Namespace) -> None:
     deployment_group_name = args.deployment_group_name
     repository_name = args.repository_name
 
-    if not commit_id:
-        commit_id = subprocess.Popen(f"echo \"$(git ls-remote {ssh_git_repo_url} | grep refs/heads/{git_repo_branch} | cut -f 1)\"", shell=True, stdout=subprocess.PIPE).stdout.read()
-        commit_id = commit_id.decode("utf-8")
-        commit_id = commit_id.strip('\n')
+    profiler = StartupProfiler(args.profile_startup)
+    metrics = Metrics.shared()
+    metrics.export_at_exit(args.metrics_path)
+    startup_cache = TTLCache(args.startup_cache)
 
-    codedeploy_client = boto3.client('codedeploy')
-
-    iam_slack_usernames_mapping = json.loads(iam_slack_usernames_mapping)
-    sts_client = boto3.client('sts')
-    response = sts_client.get_caller_identity()
-    iam_username = response['Arn'].partition('/')[-1]
-    if iam_slack_usernames_mapping.get(iam_username):
-        iam_username_log_message = f"<@{iam_slack_usernames_mapping[iam_username]}>"
-    else:
-        iam_username_log_message = f"'AWS User {iam_username}'"
+    checkpoint = watcher_checkpoint(args, 'codedeploy', project_name, deployment_group_name)
+    saved = checkpoint.load() if args.resume else None
 
     deployment_id = args.deployment_id
+    if saved:
+        deployment_id = saved["deployment_id"]
+        print(f"resuming from {checkpoint.path}...")
+
+    # the commit is only needed to create a deployment
+    if not commit_id and not deployment_id:
+        with profiler.step("git ls-remote"):
+            commit_id = resolve_commit_id(ssh_git_repo_url, git_repo_branch, startup_cache)
+
+    with profiler.step("import boto3"):
+        import boto3
+
+        if codedeploy_client is None:
+            codedeploy_client = setup_client(args, boto3.client('codedeploy', config=aws_client_config()))
+
+    with profiler.step("sts get_caller_identity"):
+        iam_slack_usernames_mapping = json.loads(iam_slack_usernames_mapping)
+        _, iam_username, _ = get_iam_identity(iam_slack_usernames_mapping, startup_cache)
+
     if not deployment_id:
         print(f"creating deployment for commit_id: {commit_id}...")
         deploy_response_data: dict = codedeploy_client.create_deployment(
@@ -66,165 +135,159 @@ def main(args: argparse.Namespace) -> None:
     deployment_info = deploy_response_data["deploymentInfo"]
     deployment_status = deployment_info["status"]
 
-    # List Deployment Instances
-    is_deployment_ready = False
-    while not is_deployment_ready:
-        try:
-            response = codedeploy_client.list_deployment_instances(
-                deploymentId=deployment_id,
-            )
-            instances_list = response["instancesList"]
-            is_deployment_ready = True
-        except Exception as err:
-            print(err)
-            print(f"deployment not ready, sleeping for 5 sec")
-            time.sleep(5)
+    with profiler.step("learn phase durations"):
+        durations = learn_deploy_event_durations(codedeploy_client, project_name, deployment_group_name, PhaseDurationCache(args.phase_durations_cache))
+    poller = AdaptivePoller(durations, phase_count=13)
 
-    deploy_phases_updated_in_slack_mapping = {}
-    for instance in instances_list:
-        deploy_phases_updated_in_slack_mapping[instance] = OrderedDict()
+    # List Deployment Targets
+    target_ids = wait_for_target_ids(codedeploy_client, deployment_id)
 
-    # Batch Get Deployment Targets
-    response = codedeploy_client.batch_get_deployment_instances(
-        deploymentId=deployment_id,
-        instanceIds=instances_list
-    )
-    for deployment_instance in response['instancesSummary']:
-        deployment_instance_id = deployment_instance['instanceId']
-        _instance_id = deployment_instance_id.rpartition("/")[-1]
-        deployment_instance_lifecycle_events = deployment_instance['lifecycleEvents']
-        deploy_phases_updated_in_slack_mapping[_instance_id] = {}
-
-        for deployment_instance_lifecycle_event in deployment_instance_lifecycle_events:
-            lifecycle_event_name = deployment_instance_lifecycle_event["lifecycleEventName"]
-            deploy_phases_updated_in_slack_mapping[_instance_id][lifecycle_event_name] = False
-
-    # Create AWS CodeDeploy Console URL
-    code_deploy_console_link = f"https://{aws_region}.console.aws.amazon.com/codesuite/codedeploy/deployments/{deployment_id}?region={aws_region}"
-
-    # Initialize Slack here
-    prefix = f"<{code_deploy_console_link}|*CodeDeploy: {project_name} - {deployment_group_name}*>"
-    if slack_link:
-        slack_link_pts = slack_link.rpartition('/')[-1]
-        msg_ts = f"{(slack_link_pts.split('p')[-1])[:-6]}.{(slack_link_pts.split('p')[-1])[-6:]}"
-        sp = SlackProgress(token=slack_token, channel=channel_name, prefix=prefix, msg_ts=msg_ts)
-    else:
-        sp = SlackProgress(token=slack_token, channel=channel_name, prefix=prefix)
+    target_fetcher = DeploymentTargetFetcher(codedeploy_client, deployment_id, max_workers=args.max_workers, target_ids=target_ids)
+    lifecycle_diff = LifecycleDiff()
     current_percentage_int = 0
-
-    # Initialize Slack ProgressBar here
-    pbar = sp.new()
-    log_message = f"Build: *{project_name}*, DeploymentStatus=`{deployment_status}`, Initiated by: {iam_username_log_message}"
-    pbar.pos = current_percentage_int
-    pbar.log(log_message)
-
+    if saved:
+        current_percentage_int = saved["current_percentage_int"]
+        lifecycle_diff.restore(saved["lifecycle_diff"])
+
+    # Initialize Slack here: one sink per destination, all fed from this one poll
+    deployment = {"project_name": project_name, "deployment_group_name": deployment_group_name, "deployment_id": deployment_id, "aws_region": aws_region}
+    sink_configs = [{"slack_token": slack_token, "channel_name": channel_name, "slack_link": slack_link or "", "iam_slack_usernames_mapping": iam_slack_usernames_mapping}]
+    sink_configs += json.loads(args.extra_sinks)
+    sink_states = saved.get("sinks", []) if saved else []
+    sinks = [
+        DeploySink(deployment, state=sink_states[n] if n < len(sink_states) else None, **sink_config)
+        for n, sink_config in enumerate(sink_configs)
+    ]
+    for sink in sinks:
+        if not sink.resumed:
+            sink.publish({"type": "started", "deployment_status": deployment_status, "iam_username": iam_username})
+    profiler.report()
+
+    # Event-driven mode: state-change events trigger the poll, the poll itself
+    # only reconciles because instance events carry no lifecycle event detail
+    event_source = None
+    if args.sqs_queue_url:
+        if sqs_client is None:
+            sqs_client = instrument_client(boto3.client('sqs', endpoint_url=args.sqs_endpoint_url or None))
+        event_source = SqsEventSource(sqs_client, args.sqs_queue_url)
+
+    poll_interval = poller.default_interval
     is_deployment_in_progress = True if deployment_status not in ['Succeeded', 'Failed', 'Stopped'] else False
     while is_deployment_in_progress:
-        print(f"Sleeping for 5 sec... {datetime.now()}")
-        time.sleep(5)
+        iteration_started_at = time.perf_counter()
+        # Record what every sink shows, and what it has yet to send, so a restarted run resumes without re-posting
+        if checkpoint:
+            checkpoint.save({
+                "deployment_id": deployment_id,
+                "current_percentage_int": current_percentage_int,
+                "lifecycle_diff": lifecycle_diff.state(),
+                "sinks": [sink.state() for sink in sinks],
+            })
+
+        wait_started_at = time.perf_counter()
+        if event_source:
+            events = event_source.wait(args.reconcile_interval, accept=lambda event: deployment_id_from_event(event) == deployment_id)
+            print(f"{len(events)} events, polling... {datetime.now()}")
+        else:
+            print(f"Sleeping for {poll_interval:.1f} sec... {datetime.now()}")
+            time.sleep(poll_interval)
+        waited = time.perf_counter() - wait_started_at
 
         ## Update new phases
-        # Get Deployment
-        deploy_response_data = codedeploy_client.get_deployment(
-            deploymentId=deployment_id
-        )
-        deployment_info = deploy_response_data["deploymentInfo"]
-        deployment_status = deployment_info["status"]
-        is_deployment_in_progress = True if deployment_status not in ['Succeeded', 'Failed', 'Stopped'] else False
-        if not is_deployment_in_progress:
-            # break here and update slack finally.
-            log_message = f"Deploy: *{project_name}*, DeployentStatus=`{deployment_status}`"
-            if deployment_status == 'Succeeded':
-                log_message_emoji = ":large_blue_circle:"
-            else:
-                log_message_emoji = ":red_circle:"
-            log_message += log_message_emoji
-            pbar.pos = 100
-            pbar.log(log_message)
-            break
-
-        # List Deployment Instances
-        response = codedeploy_client.list_deployment_instances(
-            deploymentId=deployment_id,
-        )
-        instances_list = response["instancesList"]
-
-        # Batch Get Deployment Targets
-        response = codedeploy_client.batch_get_deployment_instances(
-            deploymentId=deployment_id,
-            instanceIds=instances_list
-        )
-        for deployment_instance in response['instancesSummary']:
-            deployment_instance_id = deployment_instance['instanceId']
-            _instance_id = deployment_instance_id.rpartition("/")[-1]
-            deployment_instance_lifecycle_events = deployment_instance['lifecycleEvents']
-            if not deploy_phases_updated_in_slack_mapping.get(_instance_id):
-                deploy_phases_updated_in_slack_mapping[_instance_id] = {}
-
-            for deployment_instance_lifecycle_event in deployment_instance_lifecycle_events:
-                lifecycle_event_name = deployment_instance_lifecycle_event["lifecycleEventName"]
-                # lifecycle_event_status = deployment_instance_lifecycle_event["status"]
-                if lifecycle_event_name not in deploy_phases_updated_in_slack_mapping[_instance_id]:
-                    deploy_phases_updated_in_slack_mapping[_instance_id][lifecycle_event_name] = False
-
-        # 
-        for instance_id, instance_phases in deploy_phases_updated_in_slack_mapping.items():
-            deploy_phase_found = False
-            for _deploy_phase, _is_deploy_phase_updated_in_slack in instance_phases.items():
-                if _is_deploy_phase_updated_in_slack:
-                    continue
-
-                print(f"updating {_deploy_phase} in slack...")
-                phases_found = []
-                break_main = False
-                for deployment_instance in response['instancesSummary']:
-                    if break_main:
-                        break
-
-                    deployment_instance_id = deployment_instance['instanceId']
-                    _instance_id = deployment_instance_id.rpartition("/")[-1]
-                    if instance_id != _instance_id:
-                        continue
-
-                    deployment_instance_lifecycle_events = deployment_instance['lifecycleEvents']
-                    for deployment_instance_lifecycle_event in deployment_instance_lifecycle_events:
-                        lifecycle_event_name = deployment_instance_lifecycle_event["lifecycleEventName"]
-                        # lifecycle_event_status = deployment_instance_lifecycle_event["status"]
-                        phases_found.append(lifecycle_event_name)
-                        if _deploy_phase != lifecycle_event_name:
-                                continue
-
-                        deploy_phase_found = True
-                        break_main = True
-                        phase_type, phase_status, instance_label = lifecycle_event_name, deployment_instance_lifecycle_event.get("status"), deployment_instance.get("instanceType")
-
-                        if not phase_status:
-                            print(f"ughh, Deploy Phase {_deploy_phase} has no status yet.")
-                            break
-
-                        if phase_status in ['Pending', 'InProgress']:
-                            print(f"skipping, phase {phase_type} has status {phase_status}")
-                            continue
-
-                        log_message = f"Deploy: *{project_name}*, DeployentStatus=`{deployment_status}`"
-                        print(f"instance_label: {instance_label}")
-                        
-                        if instance_label == 'Blue':
-                            log_message_emoji = ":blue_book:"
-                        else:
-                            log_message_emoji = ":green_book:"
-
-                        instance_link = f"https://{aws_region}.console.aws.amazon.com/ec2/v2/home?region={aws_region}#Instances:instanceId={_instance_id}"
-                        log_message = f"Deployment's Phase: {phase_type}, [{log_message_emoji} <{instance_link}|*{_instance_id}*>] PhaseStatus=*{phase_status}*"
-                        current_percentage_int += 100/13
-                        current_percentage_int = round(current_percentage_int, 1)
-                        pbar.pos = current_percentage_int
-                        pbar.log(log_message)
-                        deploy_phases_updated_in_slack_mapping[_instance_id][_deploy_phase] = True
-                        break
-
-    log_message = f"{prefix} *{deployment_status}!* {iam_username_log_message}"
-    pbar.log_thread(log_message)
+        try:
+            # Get Deployment
+            deploy_response_data = codedeploy_client.get_deployment(
+                deploymentId=deployment_id
+            )
+            deployment_info = deploy_response_data["deploymentInfo"]
+            deployment_status = deployment_info["status"]
+            is_deployment_in_progress = True if deployment_status not in ['Succeeded', 'Failed', 'Stopped'] else False
+            if not is_deployment_in_progress:
+                # break here and update slack finally.
+                if args.summary:
+                    # the final counts, and the failures since the last poll
+                    failures = [lifecycle_event(transition) for transition in lifecycle_diff.update(target_fetcher.fetch(target_count=deployment_target_count(deployment_info))) if transition.status == 'Failed']
+                    publish_fleet_summary(sinks, lifecycle_diff, failures, 100)
+                publish(sinks, {"type": "status", "deployment_status": deployment_status})
+                break
+
+            # List and Batch Get Deployment Targets
+            deployment_targets = target_fetcher.fetch(target_count=deployment_target_count(deployment_info))
+        except Exception as err:
+            if classify(err)[0] != 'throttle':
+                raise
+            print(f"still throttled, skipping this poll: {err!r}")
+            poll_interval = poller.next_interval(lifecycle_diff.in_progress(), throttle_rate(codedeploy_client))
+            continue
+
+        # Post only the lifecycle events whose status changed since the last poll
+        failures = []
+        for transition in lifecycle_diff.update(deployment_targets):
+            phase_type, phase_status, _instance_id = transition.lifecycle_event_name, transition.status, transition.instance_id
+            if not phase_status:
+                print(f"ughh, Deploy Phase {phase_type} has no status yet.")
+                continue
+
+            if phase_status in ['Pending', 'InProgress']:
+                print(f"skipping, phase {phase_type} has status {phase_status}")
+                continue
+
+            # unrounded, as a large fleet's steps would round away to nothing
+            current_percentage_int += poller.share(phase_type) / len(lifecycle_diff.instance_ids)
+            if args.summary:
+                # per-instance detail only for failures, the summary counts the rest
+                if phase_status == 'Failed':
+                    failures.append(lifecycle_event(transition))
+                continue
+            print(f"updating {phase_type} in slack...")
+            publish(sinks, dict(lifecycle_event(transition), type="lifecycle", percentage=bar_percentage(current_percentage_int)))
+
+        if args.summary:
+            publish_fleet_summary(sinks, lifecycle_diff, failures, bar_percentage(current_percentage_int))
+
+        poll_interval = poller.next_interval(lifecycle_diff.in_progress(), throttle_rate(codedeploy_client))
+        # time spent working rather than waiting for the next poll
+        metrics.observe("loop_iteration_seconds", time.perf_counter() - iteration_started_at - waited, watcher="codedeploy")
+
+    publish(sinks, {"type": "finished", "deployment_status": deployment_status, "iam_username": iam_username})
+    for sink in sinks:
+        sink.close()
+    if checkpoint:
+        checkpoint.clear()
+
+
+def watch_targets(args: argparse.Namespace) -> None:
+    """
+    Watch deployments in many regions and accounts from one process, each target
+    polled on its own thread into its own Slack bars. Targets in the same account
+    and region share one pooled client, assumed roles refresh themselves.
+    `--targets` is a JSON list of {"region", "role_arn", "deployment_id"} or
+    {"region", "role_arn", "project_name", "deployment_group_name"} to create the deployment.
+    """
+    targets = load_targets(args.targets)
+    Metrics.shared().export_at_exit(args.metrics_path)
+    # one STS call for the caller's identity, rather than one from every target thread at once
+    get_iam_identity(json.loads(args.iam_slack_usernames_mapping), TTLCache(args.startup_cache))
+    pool = ClientPool(setup=lambda client, role_arn: setup_client(args, client, role_arn), config=aws_client_config())
+
+    def watch_target(target: dict) -> None:
+        target_args = argparse.Namespace(**vars(args))
+        target_args.aws_region = target["region"]
+        target_args.project_name = target.get("project_name", args.project_name)
+        target_args.deployment_group_name = target.get("deployment_group_name", args.deployment_group_name)
+        target_args.deployment_id = target.get("deployment_id", "")
+        target_args.sqs_queue_url = target.get("sqs_queue_url", "")
+        account_id = target["role_arn"].split(":")[4] if target.get("role_arn") else ""
+        if args.resume or args.checkpoint_path:
+            target_args.checkpoint_path = default_checkpoint_path('codedeploy', target["region"], account_id, target_args.deployment_id or target_args.project_name, target_args.deployment_group_name)
+        # exported once for the whole process, see above
+        target_args.metrics_path = ""
+        # clients come from the pool, as creating them on the default session from many threads is not safe
+        role_arn = target.get("role_arn", "")
+        sqs_client = pool.client('sqs', target["region"], role_arn, endpoint_url=args.sqs_endpoint_url) if target_args.sqs_queue_url else None
+        main(target_args, pool.client('codedeploy', target["region"], role_arn), sqs_client)
+
+    watch_all(watch_target, [(target, (target,)) for target in targets])
 
 
 if __name__ == "__main__":
@@ -237,6 +300,21 @@ if __name__ == "__main__":
     parser.add_argument('--iam_slack_usernames_mapping', type=str)
     parser.add_argument('--aws_region', default="eu-west-1", type=str)
     parser.add_argument('--slack_link', type=str)
+    parser.add_argument('--summary', action='store_true', help="one line per lifecycle event with instance counts instead of a line per instance, failures go to the thread")
+    parser.add_argument('--extra_sinks', default="[]", type=str, help='more Slack destinations fed from the same poll, JSON list of {"slack_token", "channel_name", "slack_link", "iam_slack_usernames_mapping", "links"}')
+    parser.add_argument('--phase_durations_cache', default=DEFAULT_CACHE_PATH, type=str)
+    parser.add_argument('--startup_cache', default=DEFAULT_STARTUP_CACHE_PATH, type=str)
+    parser.add_argument('--profile_startup', action='store_true')
+    parser.add_argument('--metrics_path', default="", type=str, help="write metrics at exit, Prometheus textfile if it ends in .prom, JSON otherwise")
+    parser.add_argument('--sqs_queue_url', default="", type=str)
+    parser.add_argument('--sqs_endpoint_url', default="", type=str)
+    parser.add_argument('--reconcile_interval', default=60, type=int)
+    parser.add_argument('--max_workers', default=8, type=int)
+    parser.add_argument('--poll_cache_ttl', default=0, type=float, help="seconds a response is shared with other processes, 0 to disable")
+    parser.add_argument('--poll_cache_dir', default=DEFAULT_POLL_CACHE_DIR, type=str)
+    parser.add_argument('--resume', action='store_true', help="checkpoint every tick, and resume from the checkpoint of a killed run")
+    parser.add_argument('--targets', default="", type=str, help='JSON list of {"region", "role_arn", "deployment_id"} to watch from one process')
+    parser.add_argument('--checkpoint_path', default="", type=str, help="checkpoint every tick to this file, give parallel runs of one project different files")
 
     parser.add_argument('--project_name', type=str)
     parser.add_argument('--deployment_group_name', type=str)
@@ -249,4 +327,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    main(args=args)
+    if args.targets:
+        watch_targets(args=args)
+    else:
+        main(args=args)
@@ -0,0 +1,101 @@
+from collections import Counter, namedtuple
+
+# one lifecycle event of one instance that changed status between two polls
+Transition = namedtuple("Transition", ["instance_id", "lifecycle_event_name", "status", "instance_label", "start_time"])
+
+
+def index_instances(instances_summary: list) -> dict:
+    """
+    Index a batch_get_deployment_instances snapshot
+    returns: dict of instance id -> {lifecycle event name -> lifecycle event}, in lifecycle order
+    """
+    index = {}
+    for deployment_instance in instances_summary:
+        # instance ids come back as `arn:...:instance/i-123` or plain `i-123`
+        instance_id = deployment_instance["instanceId"]
+        instance_id = instance_id[instance_id.rfind("/") + 1:]
+        events = index[instance_id] = {}
+        label = deployment_instance.get("instanceType")
+        for lifecycle_event in deployment_instance["lifecycleEvents"]:
+            events[lifecycle_event["lifecycleEventName"]] = (lifecycle_event.get("status"), label, lifecycle_event.get("startTime"))
+    return index
+
+
+class LifecycleDiff(object):
+    """
+    Compares successive snapshots of a deployment's instances and yields only the
+    (instance, lifecycle event, status) transitions, in O(instances x events) per poll
+    """
+
+    def __init__(self):
+        self._previous = {}
+
+    @property
+    def instance_ids(self) -> list:
+        return list(self._previous)
+
+    def update(self, instances_summary: list) -> list:
+        """
+        Record a new snapshot and return the transitions since the previous one.
+        Instances missing from `instances_summary` keep their last known state.
+        """
+        transitions = []
+        for instance_id, events in index_instances(instances_summary).items():
+            previous_events = self._previous.get(instance_id, {})
+            for lifecycle_event_name, event in events.items():
+                if event[0] != previous_events.get(lifecycle_event_name, (None,))[0]:
+                    transitions.append(Transition(instance_id, lifecycle_event_name, *event))
+            self._previous[instance_id] = events
+        return transitions
+
+    def state(self) -> dict:
+        """
+        JSON-serialisable statuses of the last snapshot, for LifecycleDiff.restore
+        """
+        return {
+            instance_id: {lifecycle_event_name: event[0] for lifecycle_event_name, event in events.items()}
+            for instance_id, events in self._previous.items()
+        }
+
+    def restore(self, state: dict) -> None:
+        self._previous = {
+            instance_id: {lifecycle_event_name: (status, None, None) for lifecycle_event_name, status in events.items()}
+            for instance_id, events in state.items()
+        }
+
+    def summary(self) -> dict:
+        """
+        Instances per status of every lifecycle event, in lifecycle order
+        returns: dict of lifecycle event name -> Counter of status -> instance count
+        """
+        counts = {}
+        for events in self._previous.values():
+            for lifecycle_event_name, event in events.items():
+                counts.setdefault(lifecycle_event_name, Counter())[event[0]] += 1
+        return counts
+
+    def in_progress(self) -> list:
+        """
+        (lifecycle event name, start time) of every lifecycle event still running
+        """
+        return [
+            (lifecycle_event_name, event[2])
+            for events in self._previous.values()
+            for lifecycle_event_name, event in events.items()
+            if event[0] == 'InProgress'
+        ]
+
+
+def format_fleet_summary(summary: dict, instance_count: int) -> str:
+    """
+    One line per lifecycle event, e.g. "AfterInstall 187/200 ✓ 3 ✗ 10 pending",
+    the same size whatever the number of instances
+    params:
+        - summary(dict): LifecycleDiff.summary()
+    """
+    lines = []
+    for lifecycle_event_name, counts in summary.items():
+        done = counts['Succeeded'] + counts['Skipped']
+        pending = instance_count - done - counts['Failed']
+        lines.append(f"{lifecycle_event_name} {done}/{instance_count} ✓ {counts['Failed']} ✗ {pending} pending")
+    return '\n'.join(lines)
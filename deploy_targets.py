@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+# batch_get_deployment_targets accepts at most 25 target ids per call
+BATCH_GET_DEPLOYMENT_TARGETS_MAX_IDS = 25
+
+# target statuses that never change again, so the target need not be fetched again
+TERMINAL_TARGET_STATUSES = ['Succeeded', 'Failed', 'Skipped']
+
+
+def list_deployment_target_ids(codedeploy_client, deployment_id: str) -> list:
+    """
+    All target ids of a deployment, following `nextToken` through every page
+    """
+    target_ids = []
+    kwargs = {"deploymentId": deployment_id}
+    while True:
+        response = codedeploy_client.list_deployment_targets(**kwargs)
+        target_ids.extend(response.get("targetIds", []))
+        if not response.get("nextToken"):
+            return target_ids
+        kwargs["nextToken"] = response["nextToken"]
+
+
+def deployment_target_count(deployment_info: dict):
+    """
+    Number of targets get_deployment reports in `deploymentOverview`, None if it reports none
+    """
+    return sum(deployment_info.get("deploymentOverview", {}).values()) or None
+
+
+def normalize_target(deployment_target: dict) -> dict:
+    """
+    Flatten an EC2/ECS/Lambda/CloudFormation deployment target into the
+    `instancesSummary` shape the rest of code_deploy.py works with
+    """
+    target = (
+        deployment_target.get("instanceTarget")
+        or deployment_target.get("ecsTarget")
+        or deployment_target.get("lambdaTarget")
+        or deployment_target.get("cloudFormationTarget")
+        or {}
+    )
+    return {
+        "instanceId": target.get("targetId", ""),
+        "instanceType": target.get("instanceLabel"),
+        "status": target.get("status"),
+        "lifecycleEvents": target.get("lifecycleEvents", []),
+    }
+
+
+class DeploymentTargetFetcher(object):
+    """
+    Fetches every target of a deployment: ids are listed with full pagination once,
+    and again only every `refresh_interval` sec or when the deployment reports a
+    different number of targets, batch_get_deployment_targets calls are chunked and
+    run in parallel on a bounded thread pool, and targets in a terminal status are
+    served from memory instead of being fetched again.
+    params:
+        - max_workers(int): concurrent batch_get_deployment_targets calls
+        - target_ids(list): ids already listed, e.g. while waiting for the deployment to start
+        - refresh_interval(float): seconds the listed ids are trusted for
+    """
+
+    def __init__(self, codedeploy_client, deployment_id: str, max_workers=8, target_ids=None, refresh_interval=300):
+        self.codedeploy_client = codedeploy_client
+        self.deployment_id = deployment_id
+        self.max_workers = max_workers
+        self.refresh_interval = refresh_interval
+        self._finished_targets = {}
+        self._target_ids = target_ids
+        self._listed_at = time.monotonic()
+
+    def target_ids(self, target_count=None) -> list:
+        """
+        params:
+            - target_count(int): number of targets the deployment reports, see deployment_target_count
+        """
+        if (
+            self._target_ids is None
+            or time.monotonic() - self._listed_at >= self.refresh_interval
+            or (target_count is not None and target_count != len(self._target_ids))
+        ):
+            self._target_ids = list_deployment_target_ids(self.codedeploy_client, self.deployment_id)
+            self._listed_at = time.monotonic()
+        return self._target_ids
+
+    def fetch(self, target_ids=None, target_count=None) -> list:
+        """
+        params:
+            - target_ids(list): targets to fetch, all of the deployment's by default
+            - target_count(int): number of targets the deployment reports, relists the ids when it changes
+        returns: list of targets in `instancesSummary` shape
+        """
+        if target_ids is None:
+            target_ids = self.target_ids(target_count)
+
+        stale_ids = [target_id for target_id in target_ids if target_id not in self._finished_targets]
+        chunks = [
+            stale_ids[i:i + BATCH_GET_DEPLOYMENT_TARGETS_MAX_IDS]
+            for i in range(0, len(stale_ids), BATCH_GET_DEPLOYMENT_TARGETS_MAX_IDS)
+        ]
+        fetched = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for targets in executor.map(self._batch_get, chunks):
+                for target in targets:
+                    fetched[target["instanceId"]] = target
+                    if target["status"] in TERMINAL_TARGET_STATUSES:
+                        self._finished_targets[target["instanceId"]] = target
+
+        return [
+            self._finished_targets.get(target_id) or fetched[target_id]
+            for target_id in target_ids
+            if target_id in self._finished_targets or target_id in fetched
+        ]
+
+    def _batch_get(self, target_ids: list) -> list:
+        response = self.codedeploy_client.batch_get_deployment_targets(
+            deploymentId=self.deployment_id,
+            targetIds=target_ids
+        )
+        return [normalize_target(deployment_target) for deployment_target in response["deploymentTargets"]]
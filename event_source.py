@@ -0,0 +1,113 @@
+import json
+import math
+import time
+
+# EventBridge detail-types delivered to the queue
+BUILD_PHASE_CHANGE = "CodeBuild Build Phase Change"
+BUILD_STATE_CHANGE = "CodeBuild Build State Change"
+DEPLOYMENT_STATE_CHANGE = "CodeDeploy Deployment State-change Notification"
+INSTANCE_STATE_CHANGE = "CodeDeploy Instance State-change Notification"
+
+# SQS long polling waits at most 20 sec and returns at most 10 messages per call
+SQS_MAX_WAIT_TIME_SECONDS = 20
+SQS_MAX_NUMBER_OF_MESSAGES = 10
+
+# shortest time an event released for other watchers stays hidden, from this watcher too
+RELEASED_VISIBILITY_TIMEOUT = 10
+
+# final states, after which no watcher needs the build's or deployment's events
+FINAL_BUILD_STATUSES = ["SUCCEEDED", "FAILED", "FAULT", "STOPPED", "TIMED_OUT"]
+FINAL_DEPLOYMENT_STATES = ["SUCCESS", "FAILURE", "STOP"]
+
+
+def build_id_from_event(event: dict) -> str:
+    """
+    CodeBuild events carry the build ARN, batch_get_builds uses `project:uuid`
+    """
+    return event.get("detail", {}).get("build-id", "").rpartition("build/")[-1]
+
+
+def deployment_id_from_event(event: dict) -> str:
+    return event.get("detail", {}).get("deploymentId", "")
+
+
+def is_stale_event(event: dict) -> bool:
+    """
+    True for events no watcher will use: about no build or deployment, or reporting a final state,
+    which every watcher also picks up when it reconciles
+    """
+    detail = event["detail"]
+    if not build_id_from_event(event) and not deployment_id_from_event(event):
+        return True
+    if event["detail-type"] == BUILD_STATE_CHANGE:
+        return detail.get("build-status") in FINAL_BUILD_STATUSES
+    if event["detail-type"] == DEPLOYMENT_STATE_CHANGE:
+        return detail.get("state") in FINAL_DEPLOYMENT_STATES
+    return False
+
+
+class SqsEventSource(object):
+    """
+    Long-polls an SQS queue that an EventBridge rule delivers
+    CodeBuild/CodeDeploy state-change events to.
+    params:
+        - sqs_client: boto3 SQS client, pass `endpoint_url` to it to use ElasticMQ or moto server
+        - queue_url(str): URL of the queue
+    """
+
+    def __init__(self, sqs_client, queue_url: str):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+
+    def wait(self, timeout: float, accept, drop=None) -> list:
+        """
+        Wait up to `timeout` sec for events, returning as soon as any arrive.
+        Events for which `accept(event)` is false are deleted if they are stale
+        (see is_stale_event) or `drop(event)` is true, e.g. late events of a build
+        this watcher has finished with. The others are released to other watchers,
+        hidden for the rest of this wait (and at least RELEASED_VISIBILITY_TIMEOUT
+        sec), so this wait does not receive them again and spin on them.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+
+            response = self.sqs_client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=SQS_MAX_NUMBER_OF_MESSAGES,
+                WaitTimeSeconds=min(SQS_MAX_WAIT_TIME_SECONDS, max(1, int(remaining))),
+            )
+            events, handled, released = [], [], []
+            for message in response.get("Messages", []):
+                event = self._parse(message["Body"])
+                entry = {"Id": message["MessageId"], "ReceiptHandle": message["ReceiptHandle"]}
+                if event is not None and accept(event):
+                    events.append(event)
+                    handled.append(entry)
+                elif event is None or is_stale_event(event) or (drop and drop(event)):
+                    # not an event we understand, or one nobody needs anymore
+                    handled.append(entry)
+                else:
+                    released.append(dict(entry, VisibilityTimeout=max(RELEASED_VISIBILITY_TIMEOUT, math.ceil(remaining))))
+
+            if handled:
+                self.sqs_client.delete_message_batch(QueueUrl=self.queue_url, Entries=handled)
+            if released:
+                self.sqs_client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=released)
+            if events:
+                return events
+
+    @staticmethod
+    def _parse(body: str):
+        try:
+            event = json.loads(body)
+            # events fanned out through SNS arrive wrapped in a notification
+            if "Message" in event and "detail-type" not in event:
+                event = json.loads(event["Message"])
+        except (TypeError, ValueError):
+            return None
+        if "detail-type" not in event or "detail" not in event:
+            return None
+        return event
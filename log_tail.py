@@ -0,0 +1,84 @@
+from collections import deque
+
+# longest log line kept, so one huge line cannot blow up the ring buffer or the Slack message
+MAX_LINE_LENGTH = 500
+
+
+class LogTail(object):
+    """
+    Keeps the last `max_lines` lines of a CloudWatch Logs stream while it is being written.
+    Each poll reads only the events written since the previous one by following
+    `nextForwardToken`; if a poll falls more than `max_pages` pages behind it jumps
+    to the end of the stream instead, as only the last lines are ever posted.
+    Memory and calls per poll stay flat however long the build runs.
+    params:
+        - group_name(str): log group, e.g. build["logs"]["groupName"]
+        - stream_name(str): log stream, e.g. build["logs"]["streamName"]
+        - max_lines(int): lines kept in the ring buffer
+        - max_pages(int): get_log_events calls per poll before jumping to the end
+    """
+
+    def __init__(self, logs_client, group_name: str, stream_name: str, max_lines=50, max_pages=5, state=None):
+        self.logs_client = logs_client
+        self.group_name = group_name
+        self.stream_name = stream_name
+        self.max_lines = max_lines
+        self.max_pages = max_pages
+        self.next_token = None
+        self.lines = deque(maxlen=max_lines)
+        if state:
+            self.next_token = state["next_token"]
+            self.lines.extend(state["lines"])
+
+    def state(self) -> dict:
+        """
+        JSON-serialisable state for resuming the tail where it stopped
+        """
+        return {"group_name": self.group_name, "stream_name": self.stream_name, "next_token": self.next_token, "lines": list(self.lines)}
+
+    def poll(self) -> None:
+        """
+        Read the events written since the last poll into the ring buffer
+        """
+        try:
+            if self.next_token is None:
+                self._read_end()
+                return
+
+            for _ in range(self.max_pages):
+                response = self.logs_client.get_log_events(
+                    logGroupName=self.group_name,
+                    logStreamName=self.stream_name,
+                    nextToken=self.next_token,
+                    startFromHead=True,
+                )
+                self._add(response["events"])
+                # the forward token stays the same once the end of the stream is reached
+                if response["nextForwardToken"] == self.next_token:
+                    return
+                self.next_token = response["nextForwardToken"]
+
+            print(f"log stream {self.stream_name} is more than {self.max_pages} pages ahead, jumping to its end")
+            self._read_end()
+        except self.logs_client.exceptions.ResourceNotFoundException:
+            # the stream only exists once the build has been provisioned
+            pass
+
+    def _read_end(self) -> None:
+        # without a token, get_log_events returns the most recent events
+        response = self.logs_client.get_log_events(
+            logGroupName=self.group_name,
+            logStreamName=self.stream_name,
+            limit=self.max_lines,
+            startFromHead=False,
+        )
+        self.lines.clear()
+        self._add(response["events"])
+        self.next_token = response["nextForwardToken"]
+
+    def _add(self, events: list) -> None:
+        for event in events:
+            for line in event["message"].rstrip("\n").splitlines():
+                if len(line) > MAX_LINE_LENGTH:
+                    line = line[:MAX_LINE_LENGTH] + "..."
+                self.lines.append(line)
@@ -0,0 +1,172 @@
+import atexit
+from contextlib import contextmanager
+import json
+import os
+import tempfile
+import threading
+import time
+
+# upper bounds (sec) of the latency histogram buckets, from a fast AWS call to a long Retry-After
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """
+    Cumulative latency histogram in the Prometheus sense: each bucket counts
+    the observations less than or equal to its upper bound
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0,
+            "max": round(self.max, 6),
+            "buckets": {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+
+class Metrics(object):
+    """
+    Latency histograms and counters of the watcher hot paths, exported at exit
+    as a Prometheus textfile (`.prom`) or a JSON summary (anything else).
+    Every series is a metric name plus labels, e.g.
+    observe("aws_call_seconds", 0.12, operation="batch_get_builds")
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, prefix="aws_updates_to_slack"):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Return the registry shared by every module in the process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def inc(self, name: str, value=1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observe how long the `with` block took, whether or not it raised
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self) -> dict:
+        def series_name(name, labels):
+            return name + ("{" + ",".join(f"{key}={value}" for key, value in labels) + "}" if labels else "")
+
+        with self._lock:
+            return {
+                "histograms": {series_name(*key): histogram.summary() for key, histogram in sorted(self.histograms.items())},
+                "counters": {series_name(*key): value for key, value in sorted(self.counters.items())},
+            }
+
+    def prometheus_text(self) -> str:
+        def series(name, labels, extra=()):
+            label_text = ",".join(f'{key}="{value}"' for key, value in tuple(labels) + tuple(extra))
+            return f"{self.prefix}_{name}{{{label_text}}}" if label_text else f"{self.prefix}_{name}"
+
+        lines = []
+        with self._lock:
+            for name in sorted(set(name for name, _ in self.histograms)):
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for (_, labels), histogram in sorted(item for item in self.histograms.items() if item[0][0] == name):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{series(name + '_bucket', labels, [('le', bound)])} {count}")
+                    lines.append(f"{series(name + '_bucket', labels, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{series(name + '_sum', labels)} {histogram.sum}")
+                    lines.append(f"{series(name + '_count', labels)} {histogram.count}")
+            for name in sorted(set(name for name, _ in self.counters)):
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                for (_, labels), value in sorted(item for item in self.counters.items() if item[0][0] == name):
+                    lines.append(f"{series(name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str) -> None:
+        """
+        Write the metrics to `path` atomically, so a node_exporter textfile
+        collector never reads a half-written file
+        """
+        if path.endswith(".prom"):
+            content = self.prometheus_text()
+        else:
+            content = json.dumps(self.summary(), indent=2)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def export_at_exit(self, path: str) -> None:
+        if path:
+            atexit.register(self.export, path)
+
+
+def instrument_client(client):
+    """
+    Time every call of a boto3 client into `aws_call_seconds`, and count the
+    retries botocore made and the calls that still failed, by error code
+    """
+    from botocore import xform_name
+
+    metrics = Metrics.shared()
+
+    def before_call(model, context, **kwargs):
+        context["metrics_started_at"] = time.perf_counter()
+
+    def after_call(model, parsed, context, **kwargs):
+        operation = xform_name(model.name)
+        started_at = context.pop("metrics_started_at", None)
+        if started_at is not None:
+            metrics.observe("aws_call_seconds", time.perf_counter() - started_at, operation=operation)
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            metrics.inc("aws_retries_total", retries, operation=operation)
+        error_code = parsed.get("Error", {}).get("Code", "")
+        if error_code:
+            metrics.inc("aws_errors_total", operation=operation, code=error_code)
+
+    # registered first so a handler that answers the call itself (e.g. Stubber) does not hide it
+    client.meta.events.register_first("before-call.*.*", before_call)
+    client.meta.events.register("after-call.*.*", after_call)
+    return client
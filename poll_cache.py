@@ -0,0 +1,162 @@
+from datetime import datetime
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from metrics import Metrics
+from startup import credentials_key
+
+DEFAULT_POLL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "aws-updates-to-slack", "poll_cache")
+
+# read-only calls the watchers repeat every tick, safe to answer from another process's response
+SHARED_OPERATIONS = [
+    "GetDeployment",
+    "ListDeploymentTargets",
+    "BatchGetDeploymentTargets",
+    "BatchGetBuilds",
+    "BatchGetBuildBatches",
+]
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _decode(value: dict):
+    if "__datetime__" in value:
+        return datetime.fromisoformat(value["__datetime__"])
+    return value
+
+
+class SharedPollCache(object):
+    """
+    Responses of describe calls shared by every watcher process on the machine.
+    Each call key has a lock file: the first process to take the lock makes the
+    AWS call and writes the response, processes asking for the same call meanwhile
+    wait on the lock and then read that response, as long as it is younger than `ttl`.
+    params:
+        - directory(str): where responses and lock files are kept, private to the user
+        - ttl(float): seconds a response is served to other processes
+    """
+
+    def __init__(self, directory=DEFAULT_POLL_CACHE_DIR, ttl=5, max_age=24 * 60 * 60):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.prune(max_age)
+
+    def key(self, client, operation_name: str, params: dict, scope="") -> str:
+        # different credentials, roles or regions must never see each other's responses
+        raw = json.dumps([credentials_key(), scope, client.meta.region_name, operation_name, params], sort_keys=True, default=_encode)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def lock(self, key: str) -> int:
+        """
+        Block until this process holds the lock of `key`, returns the lock fd for `unlock`
+        """
+        fd = os.open(os.path.join(self.directory, f"{key}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    @staticmethod
+    def unlock(fd: int) -> None:
+        # closing the fd releases the flock
+        os.close(fd)
+
+    def read(self, key: str):
+        """
+        returns: the cached response of `key`, or None if there is none younger than `ttl`
+        """
+        try:
+            with open(os.path.join(self.directory, f"{key}.json")) as f:
+                entry = json.load(f, object_hook=_decode)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["stored_at"] > self.ttl:
+            return None
+        # botocore's retries were spent by the process that made the call
+        entry["response"].get("ResponseMetadata", {}).pop("RetryAttempts", None)
+        return entry["response"]
+
+    def write(self, key: str, response: dict) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"stored_at": time.time(), "response": response}, f, default=_encode)
+        os.replace(tmp_path, os.path.join(self.directory, f"{key}.json"))
+
+    def prune(self, max_age: float) -> None:
+        """
+        Remove responses and lock files nobody has touched for `max_age` sec
+        """
+        now = time.time()
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def share_calls(client, cache: SharedPollCache, operations=SHARED_OPERATIONS, scope=""):
+    """
+    Route the `operations` calls of a boto3 client through `cache`, so identical
+    calls from watchers in other processes within `cache.ttl` cost one AWS call
+    params:
+        - scope(str): what the client's credentials stand for beyond the environment, e.g. an assumed role
+    """
+    from botocore.awsrequest import AWSResponse
+
+    metrics = Metrics.shared()
+
+    def keep_params(params, model, context, **kwargs):
+        if model.name in operations:
+            context["poll_cache_params"] = dict(params)
+
+    def before_call(model, context, **kwargs):
+        if model.name not in operations:
+            return None
+        key = cache.key(client, model.name, context.get("poll_cache_params", {}), scope)
+        fd = cache.lock(key)
+        try:
+            response = cache.read(key)
+        except BaseException:
+            cache.unlock(fd)
+            raise
+        if response is not None:
+            cache.unlock(fd)
+            metrics.inc("poll_cache_hits_total", operation=model.name)
+            return AWSResponse(None, 200, {}, None), response
+        # hold the lock over the AWS call, so the other processes wait for its response
+        context["poll_cache_lock"] = (key, fd)
+        return None
+
+    def after_call(http_response, parsed, context, **kwargs):
+        if "poll_cache_lock" not in context:
+            return
+        key, fd = context.pop("poll_cache_lock")
+        try:
+            if http_response.status_code == 200:
+                cache.write(key, parsed)
+        finally:
+            cache.unlock(fd)
+
+    def after_call_error(context, **kwargs):
+        if "poll_cache_lock" in context:
+            cache.unlock(context.pop("poll_cache_lock")[1])
+
+    client.meta.events.register("before-parameter-build.*.*", keep_params)
+    # registered first so a handler that answers the call itself (e.g. Stubber) does not bypass the cache
+    client.meta.events.register_first("before-call.*.*", before_call)
+    client.meta.events.register("after-call.*.*", after_call)
+    client.meta.events.register("after-call-error.*.*", after_call_error)
+    return client
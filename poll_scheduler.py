@@ -0,0 +1,166 @@
+from datetime import datetime, timezone
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from deploy_targets import DeploymentTargetFetcher, list_deployment_target_ids
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "aws-updates-to-slack", "phase_durations.json")
+
+
+class PhaseDurationCache(object):
+    """
+    On-disk cache of typical phase durations (in seconds), keyed by project
+    params:
+        - path(str): JSON file holding the cache
+        - ttl(int): seconds before an entry is learned again
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key: str):
+        entry = self._load().get(key)
+        if not entry or time.time() - entry["learned_at"] > self.ttl:
+            return None
+        return entry["durations"]
+
+    def put(self, key: str, durations: dict) -> None:
+        data = self._load()
+        data[key] = {"learned_at": time.time(), "durations": durations}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # write to a temp file first so concurrent runs never read half a file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+def _median_durations(samples: dict) -> dict:
+    return {name: statistics.median(values) for name, values in samples.items() if values}
+
+
+def learn_build_phase_durations(codebuild_client, project_name: str, cache: PhaseDurationCache, max_builds=20) -> dict:
+    """
+    Median duration of every phase over the last successful builds of a project
+    """
+    key = f"codebuild:{project_name}"
+    durations = cache.get(key)
+    if durations is not None:
+        return durations
+
+    response = codebuild_client.list_builds_for_project(
+        projectName=project_name,
+        sortOrder="DESCENDING",
+    )
+    build_ids = response["ids"][:max_builds]
+    samples = {}
+    if build_ids:
+        response = codebuild_client.batch_get_builds(ids=build_ids)
+        for build in response["builds"]:
+            if build["buildStatus"] != "SUCCEEDED":
+                continue
+            for phase in build.get("phases", []):
+                if "durationInSeconds" in phase:
+                    samples.setdefault(phase["phaseType"], []).append(phase["durationInSeconds"])
+
+    durations = _median_durations(samples)
+    cache.put(key, durations)
+    return durations
+
+
+def learn_deploy_event_durations(codedeploy_client, application_name: str, deployment_group_name: str, cache: PhaseDurationCache, max_deployments=5, max_targets=25) -> dict:
+    """
+    Median duration of every lifecycle event over the last successful deployments of a deployment group
+    """
+    key = f"codedeploy:{application_name}:{deployment_group_name}"
+    durations = cache.get(key)
+    if durations is not None:
+        return durations
+
+    response = codedeploy_client.list_deployments(
+        applicationName=application_name,
+        deploymentGroupName=deployment_group_name,
+        includeOnlyStatuses=["Succeeded"],
+    )
+    samples = {}
+    for deployment_id in response["deployments"][:max_deployments]:
+        target_ids = list_deployment_target_ids(codedeploy_client, deployment_id)[:max_targets]
+        if not target_ids:
+            continue
+
+        for deployment_instance in DeploymentTargetFetcher(codedeploy_client, deployment_id).fetch(target_ids):
+            for lifecycle_event in deployment_instance["lifecycleEvents"]:
+                if lifecycle_event.get("startTime") and lifecycle_event.get("endTime"):
+                    duration = (lifecycle_event["endTime"] - lifecycle_event["startTime"]).total_seconds()
+                    samples.setdefault(lifecycle_event["lifecycleEventName"], []).append(duration)
+
+    durations = _median_durations(samples)
+    cache.put(key, durations)
+    return durations
+
+
+class AdaptivePoller(object):
+    """
+    Picks poll intervals and progress steps from historical phase durations:
+    polls rarely in the middle of long phases and quickly near expected transitions.
+    Without history it falls back to a fixed interval and equal progress steps.
+    params:
+        - durations(dict): phase name -> typical duration in seconds
+        - phase_count(int): number of phases expected when there is no history
+    """
+
+    def __init__(self, durations: dict, phase_count: int, min_interval=2, max_interval=30, default_interval=5):
+        self.durations = durations or {}
+        self.phase_count = phase_count
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self._total = sum(self.durations.values())
+
+    def share(self, phase: str) -> float:
+        """
+        Percentage of the whole run that completing `phase` represents
+        """
+        if not self._total:
+            return 100 / self.phase_count
+        return 100 * self.durations.get(phase, 0) / self._total
+
+    def next_interval(self, in_progress: list, throttle_rate=0.0) -> float:
+        """
+        Seconds to sleep before the next poll
+        params:
+            - in_progress(list): (phase name, start time) of every phase still running
+            - throttle_rate(float): share of recent AWS calls that were throttled, stretches the interval
+        """
+        intervals = []
+        now = datetime.now(timezone.utc)
+        for phase, start_time in in_progress:
+            expected = self.durations.get(phase)
+            if expected is None or start_time is None:
+                intervals.append(self.default_interval)
+                continue
+
+            remaining = expected - (now - start_time).total_seconds()
+            if remaining > 0:
+                # sleep half of what is left, so polls get denser towards the transition
+                intervals.append(remaining / 2)
+            else:
+                # overrunning: back off slowly the longer the phase overruns
+                intervals.append(-remaining / 4)
+
+        # e.g. with a quarter of the calls throttled, polls are twice as far apart
+        slowdown = 1 + 4 * throttle_rate
+        if not intervals:
+            return self.default_interval * slowdown
+        return slowdown * min(self.max_interval, max(self.min_interval, min(intervals)))
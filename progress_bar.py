@@ -1,20 +1,192 @@
+import asyncio
+import atexit
+from collections import deque
+import hashlib
+import threading
 import time
 
-from slack_sdk import WebClient
+from metrics import Metrics
+from retry import Retrier
 
+# Slack says how long to back off with Retry-After, so rate limits get a generous budget
+SLACK_RETRY_BUDGETS = {"throttle": 20, "transient": 3}
 
-class Slacker:
-    def __init__(self, token):
-        self.client = WebClient(token=token)
+
+class SlackTransport(object):
+    """
+    Runs every Slack call on one background asyncio loop, with one AsyncWebClient
+    (and so one HTTP session) per token and at most `max_concurrency` calls in flight.
+    Callers on other threads get a concurrent.futures.Future back and never wait
+    on Slack unless they ask to.
+    params:
+        - max_concurrency(int): Slack calls in flight at once, across all bars
+        - base_url(str): Slack Web API base URL, e.g. a local stand-in for benchmarks
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_concurrency=8, base_url=None):
+        self.max_concurrency = max_concurrency
+        self.base_url = base_url
+        self._clients = {}
+        self._semaphore = None
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='slack-transport', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def shared(cls):
+        """
+        Return the transport shared by every SlackProgress in the process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, **kwargs):
+        """
+        Replace the shared transport, so every SlackProgress created afterwards uses the new settings
+        """
+        with cls._shared_lock:
+            cls._shared = cls(**kwargs)
+            return cls._shared
+
+    async def call(self, token, method_name, **kwargs):
+        """
+        Call a Slack Web API method, must run on the transport loop
+        """
+        if token not in self._clients:
+            # imported here so a script pays for aiohttp/slack_sdk only once it talks to Slack
+            import aiohttp
+            from slack_sdk.web.async_client import AsyncWebClient
+
+            client_kwargs = {"base_url": self.base_url} if self.base_url else {}
+            self._clients[token] = AsyncWebClient(token=token, session=aiohttp.ClientSession(), **client_kwargs)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await getattr(self._clients[token], method_name)(**kwargs)
+
+    def submit(self, coro):
+        """
+        Schedule `coro` on the transport loop from any thread
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def run(self, coro):
+        """
+        Run `coro` on the transport loop and wait for its result
+        """
+        return self.submit(coro).result()
+
+    def close(self, timeout=60):
+        """
+        Wait for in-flight Slack calls, then close every HTTP session
+        """
+        with self._pending_lock:
+            pending = list(self._pending)
+        for future in pending:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+        if self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._aclose(), self._loop).result(timeout=timeout)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _aclose(self):
+        for client in self._clients.values():
+            await client.session.close()
+        self._clients = {}
+
+    def _done(self, future):
+        with self._pending_lock:
+            self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            print(f"slack call failed: {future.exception()!r}")
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiting how many Slack calls go out for one channel.
+    params:
+        - rate(float): tokens added per second
+        - capacity(int): maximum burst size
+    """
+
+    _buckets = {}
+    _buckets_lock = threading.Lock()
+
+    def __init__(self, rate=1.0, capacity=3):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_channel(cls, token, channel, rate=1.0, capacity=3):
+        """
+        Return the bucket shared by every progress bar posting to `channel` with `token`,
+        channels of the same name in other workspaces have their own
+        """
+        with cls._buckets_lock:
+            if (token, channel) not in cls._buckets:
+                cls._buckets[(token, channel)] = cls(rate=rate, capacity=capacity)
+            return cls._buckets[(token, channel)]
+
+    def reserve(self):
+        """
+        Consume a token, returning how many seconds to wait before using it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return max(self._paused_until - now, -self._tokens / self.rate, 0)
+
+    def acquire(self):
+        """
+        Block until a token is available, then consume it
+        """
+        time.sleep(self.reserve())
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens for `seconds`, e.g. after a 429 with Retry-After
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
 
 
 class SlackProgress(object):
-    def __init__(self, token, channel, suffix='%', prefix="", msg_ts=None):
+    def __init__(self, token, channel, suffix='%', prefix="", msg_ts=None, flush_interval=1.0, rate=1.0, burst=3, max_lines=50, overflow_batch=10, transport=None):
         self.prefix = prefix
         self.suffix = suffix
         self.channel = channel
-        self.slack = Slacker(token).client
+        self.token = token
         self.msg_ts = msg_ts
+        self.flush_interval = flush_interval
+        self.max_lines = max_lines
+        self.overflow_batch = overflow_batch
+        self._bucket = TokenBucket.for_channel(token, channel, rate=rate, capacity=burst)
+        # a workspace that keeps answering 429 must not trip the circuit of the others
+        workspace_key = hashlib.sha1((token or '').encode()).hexdigest()[:8]
+        self._retrier = Retrier.for_service('slack', key=f"{workspace_key}/{channel}", budgets=SLACK_RETRY_BUDGETS)
+        self._transport = transport or SlackTransport.shared()
 
     def new(self, total=100):
         """
@@ -22,14 +194,38 @@ class SlackProgress(object):
         params:
             - total(int): total number of items
         """
+        return self._transport.run(self.anew(total))
+
+    async def anew(self, total=100):
+        """
+        Coroutine version of `new`
+        """
         if self.msg_ts:
-            res = self.slack.chat_postMessage(channel=self.channel, text=self._makebar(0), thread_ts=self.msg_ts, as_user=True)
+            res = await self._acall('chat_postMessage', channel=self.channel, text=self._makebar(0), thread_ts=self.msg_ts, as_user=True)
         else:
-            res = self.slack.chat_postMessage(channel=self.channel, text=self._makebar(0), as_user=True)
+            res = await self._acall('chat_postMessage', channel=self.channel, text=self._makebar(0), as_user=True)
 
         bar = ProgressBar(self, total)
         bar.msg_ts = res['ts']
         bar.channel_id = res['channel']
+        bar._last_text = self._makebar(0)
+        return bar
+
+    def restore(self, state):
+        """
+        Rebuild a ProgressBar from ProgressBar.state() without posting to Slack
+        params:
+            - state(dict): state saved by a previous run
+        """
+        bar = ProgressBar(self, state['total'], msg_ts=state['msg_ts'])
+        bar.channel_id = state['channel_id']
+        bar._pos = state['pos']
+        bar._msg_log = deque(state['msg_log'])
+        bar._log_text = '\n'.join(state['msg_log'])
+        bar._evicted_count = state['evicted_count']
+        bar._overflow = list(state['overflow'])
+        bar._last_text = state['last_text']
+        bar._status = state.get('status', '')
         return bar
 
     def iter(self, iterable):
@@ -41,14 +237,56 @@ class SlackProgress(object):
         for idx, item in enumerate(iterable):
             yield(item)
             bar.done = idx
+        bar.flush()
+
+    def _render(self, pos, evicted_count, log_text, status=''):
+        content = self._makebar(pos)
+        if status:
+            content += '\n' + status
+        if evicted_count:
+            content += '\n_{} earlier updates in thread_'.format(evicted_count)
+        if log_text:
+            content += '\n' + log_text
+        return content
 
-    def _update(self, chan, msg_ts, pos, msg_log):
-        content = [self._makebar(pos)] + msg_log
-        content = '\n'.join(content)
-        self.slack.chat_update(channel=chan, ts=msg_ts, text=content)
+    def _update(self, chan, msg_ts, text):
+        self._transport.run(self._aupdate(chan, msg_ts, text))
 
     def _reply_in_thread(self, chan, msg_ts, msg_log):
-        self.slack.chat_postMessage(channel=chan, text=msg_log, thread_ts=msg_ts, as_user=True)
+        self._transport.run(self._areply_in_thread(chan, msg_ts, msg_log))
+
+    async def _aupdate(self, chan, msg_ts, text):
+        await self._acall('chat_update', channel=chan, ts=msg_ts, text=text)
+
+    async def _areply_in_thread(self, chan, msg_ts, msg_log):
+        await self._acall('chat_postMessage', channel=chan, text=msg_log, thread_ts=msg_ts, as_user=True)
+
+    async def _acall(self, method_name, **kwargs):
+        """
+        Call a Slack Web API method within the channel budget, through the shared
+        Slack retrier: 429s wait out `Retry-After` and pause the channel budget,
+        5xx and connection errors are retried for edits only, as a repeated post
+        would show twice
+        """
+        from slack_sdk.errors import SlackApiError
+
+        metrics = Metrics.shared()
+
+        async def attempt():
+            with metrics.timer('slack_bucket_wait_seconds', method=method_name):
+                await asyncio.sleep(self._bucket.reserve())
+            with metrics.timer('slack_call_seconds', method=method_name):
+                return await self._transport.call(self.token, method_name, **kwargs)
+
+        def on_ratelimited(retry_after):
+            metrics.inc('slack_ratelimited_total', method=method_name)
+            self._bucket.pause(retry_after)
+
+        try:
+            return await self._retrier.acall(attempt, idempotent=method_name == 'chat_update', on_throttle=on_ratelimited)
+        except SlackApiError as err:
+            metrics.inc('slack_errors_total', method=method_name, error=err.response.get('error', ''))
+            raise
 
     def _makebar(self, pos):
         bar = (round(pos / 5) * chr(9608))
@@ -65,7 +303,21 @@ class ProgressBar(object):
         self._pos = 0
         self._done = 0
         self.total = total
-        self._msg_log = []
+        # only the last `max_lines` lines stay in the message, older ones go to the thread
+        self._msg_log = deque()
+        self._log_text = ''
+        self._evicted_count = 0
+        self._overflow = []
+        # last text Slack confirmed, and the last one queued for it if not confirmed yet
+        self._last_text = None
+        self._queued_text = None
+        # block rewritten in place under the bar, e.g. one line per child build
+        self._status = ''
+        self._timer = None
+        self._state_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        # serialises this bar's Slack calls on the transport loop, created there
+        self._alock = None
         if msg_ts:
             self.msg_ts = msg_ts
 
@@ -88,13 +340,131 @@ class ProgressBar(object):
             self._pos = val
             self._update()
 
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, val):
+        if val != self._status:
+            with self._state_lock:
+                self._status = val
+            self._update()
+
     def log(self, msg):
         timestamp = time.strftime('%X')  # returns HH:MM:SS time
-        self._msg_log.append('*{}* - [{}]'.format(timestamp, msg))
+        line = '*{}* - [{}]'.format(timestamp, msg)
+        with self._state_lock:
+            self._msg_log.append(line)
+            self._log_text = self._log_text + '\n' + line if self._log_text else line
+            while len(self._msg_log) > self._sp.max_lines:
+                evicted = self._msg_log.popleft()
+                self._log_text = self._log_text[len(evicted) + 1:]
+                self._evicted_count += 1
+                self._overflow.append(evicted)
         self._update()
 
+    def state(self):
+        """
+        JSON-serialisable state for SlackProgress.restore
+        """
+        with self._state_lock:
+            return {
+                'total': self.total,
+                'msg_ts': self.msg_ts,
+                'channel_id': self.channel_id,
+                'pos': self._pos,
+                'msg_log': list(self._msg_log),
+                'evicted_count': self._evicted_count,
+                'overflow': list(self._overflow),
+                'last_text': self._last_text,
+                'status': self._status,
+            }
+
     def log_thread(self, msg):
-        self._sp._reply_in_thread(self.channel_id, self.msg_ts, msg)
+        self.flush(flush_overflow=True, wait=False)
+        self._sp._transport.run(self._asend([[msg]], None))
+
+    async def alog_thread(self, msg):
+        """
+        Coroutine version of `log_thread`
+        """
+        await self.aflush(flush_overflow=True)
+        await asyncio.wrap_future(self._sp._transport.submit(self._asend([[msg]], None)))
+
+    def flush(self, flush_overflow=False, wait=True):
+        """
+        Send pending pos/log changes as a single edit,
+        skipping it if the rendered text has not changed.
+        Lines evicted from the message are posted to the thread in batches
+        of `overflow_batch`, or all at once with `flush_overflow`.
+        With `wait=False` the edit is queued on the transport and its future
+        (None if there was nothing to send) is returned at once.
+        """
+        future = self._submit_flush(flush_overflow)
+        if future is not None and wait:
+            future.result()
+        return future
+
+    async def aflush(self, flush_overflow=False):
+        """
+        Coroutine version of `flush`
+        """
+        future = self._submit_flush(flush_overflow)
+        if future is not None:
+            await asyncio.wrap_future(future)
+
+    def _submit_flush(self, flush_overflow):
+        # computing and queueing under one lock keeps edits in the order they were rendered
+        with self._send_lock:
+            with self._state_lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                overflow = []
+                while self._overflow and (flush_overflow or len(self._overflow) >= self._sp.overflow_batch):
+                    overflow.append(self._overflow[:self._sp.overflow_batch])
+                    del self._overflow[:self._sp.overflow_batch]
+                text = self._sp._render(self._pos, self._evicted_count, self._log_text, self._status)
+                changed = text != (self._queued_text if self._queued_text is not None else self._last_text)
+                if changed:
+                    self._queued_text = text
+
+            if not overflow and not changed:
+                return None
+            return self._sp._transport.submit(self._asend(overflow, text if changed else None))
+
+    async def _asend(self, overflow, text):
+        if self._alock is None:
+            self._alock = asyncio.Lock()
+        async with self._alock:
+            sent = 0
+            try:
+                for lines in overflow:
+                    await self._sp._areply_in_thread(self.channel_id, self.msg_ts, '\n'.join(lines))
+                    sent += 1
+                if text is not None:
+                    await self._sp._aupdate(self.channel_id, self.msg_ts, text)
+            except BaseException:
+                # keep what did not go out, so the next flush sends it again
+                with self._state_lock:
+                    self._overflow[:0] = [line for lines in overflow[sent:] for line in lines]
+                    if text is not None and self._queued_text == text:
+                        self._queued_text = None
+                raise
+            if text is not None:
+                with self._state_lock:
+                    self._last_text = text
+                    if self._queued_text == text:
+                        self._queued_text = None
 
     def _update(self):
-        self._sp._update(self.channel_id, self.msg_ts, self._pos, self._msg_log)
+        if not self._sp.flush_interval:
+            self.flush(wait=False)
+            return
+
+        # write-behind: changes within one flush window go out as one edit
+        with self._state_lock:
+            if self._timer is None:
+                self._timer = threading.Timer(self._sp.flush_interval, self.flush)
+                self._timer.start()
@@ -0,0 +1,277 @@
+import asyncio
+from collections import Counter, deque
+import functools
+import random
+import threading
+import time
+
+from metrics import Metrics
+
+# AWS error codes meaning "slow down": the request was not executed, so retrying is always safe
+THROTTLING_ERROR_CODES = [
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "SlowDown",
+    "PriorRequestNotComplete",
+]
+
+# AWS error codes of a resource that exists but is not ready to be described yet
+NOT_READY_ERROR_CODES = [
+    "DeploymentNotStartedException",
+    "DeploymentDoesNotExistException",
+]
+
+# botocore client methods that only read, so transient errors can be retried without side effects
+READ_ONLY_PREFIXES = ("get_", "list_", "batch_get_", "describe_")
+
+DEFAULT_BUDGETS = {"throttle": 8, "transient": 4}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a service keeps throttling after the circuit breaker tripped `max_trips` times in a row
+    """
+
+
+def aws_client_config():
+    """
+    botocore config for clients whose calls go through a Retrier, so botocore's own
+    retries do not multiply with it
+    """
+    from botocore.config import Config
+
+    return Config(retries={"total_max_attempts": 1})
+
+
+def classify(err: Exception) -> tuple:
+    """
+    returns: (error class or None if the error is not worth retrying, Retry-After sec or None)
+    """
+    response = getattr(err, "response", None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        code = response.get("Error", {}).get("Code", "")
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        if code in THROTTLING_ERROR_CODES or status == 429:
+            return "throttle", None
+        if code in NOT_READY_ERROR_CODES:
+            return "not_ready", None
+        if status >= 500:
+            return "transient", None
+        return None, None
+    if response is not None and hasattr(response, "status_code"):
+        # slack_sdk SlackApiError
+        if response.status_code == 429:
+            return "throttle", float(response.headers.get("Retry-After", 1))
+        if response.status_code >= 500:
+            return "transient", None
+        return None, None
+
+    transient_errors = (ConnectionError, TimeoutError, asyncio.TimeoutError)
+    try:
+        import botocore.exceptions
+
+        transient_errors += (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)
+    except ImportError:
+        pass
+    try:
+        import aiohttp
+
+        transient_errors += (aiohttp.ClientConnectionError,)
+    except ImportError:
+        pass
+    if isinstance(err, transient_errors):
+        return "transient", None
+    return None, None
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a service that keeps throttling: after `threshold` throttles in a row the
+    circuit opens and every call waits out a cooldown (doubling on each trip, up to
+    `max_cooldown`) instead of adding to the load. A success closes it again; tripping
+    more than `max_trips` times in a row gives up with CircuitOpenError.
+    """
+
+    def __init__(self, threshold=5, cooldown=30, max_cooldown=300, max_trips=5):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_trips = max_trips
+        self._consecutive = 0
+        self._trips = 0
+        self._open_until = 0
+        self._lock = threading.Lock()
+
+    def wait_time(self) -> float:
+        """
+        Seconds to wait before the next call
+        """
+        with self._lock:
+            if self._trips > self.max_trips:
+                raise CircuitOpenError(f"still throttled after {self.max_trips} cooldowns")
+            return max(0, self._open_until - time.monotonic())
+
+    def record(self, throttled: bool) -> None:
+        with self._lock:
+            if not throttled:
+                self._consecutive = 0
+                self._trips = 0
+                return
+
+            self._consecutive += 1
+            now = time.monotonic()
+            if self._consecutive >= self.threshold and now >= self._open_until:
+                self._trips += 1
+                cooldown = min(self.max_cooldown, self.cooldown * 2 ** (self._trips - 1))
+                self._open_until = now + cooldown
+                self._consecutive = 0
+                print(f"circuit open: {self.threshold} throttled calls in a row, pausing calls for {cooldown} sec")
+
+
+class Retrier(object):
+    """
+    The retry layer shared by every call to one service, or one account and region of it: jittered
+    exponential backoff ("full jitter", so many watchers do not retry in step),
+    a retry budget per error class and per call, a circuit breaker, and the
+    recent throttle rate, for poll loops to slow down with.
+    params:
+        - service(str): label in logs and metrics, e.g. "aws" or "slack"
+        - key(str): the part of the service this retrier is for, in logs
+        - budgets(dict): error class -> retries allowed per call
+        - base(float): backoff of the first retry, doubled on every retry up to `cap`
+        - window(int): calls the throttle rate is measured over
+    """
+
+    _retriers = {}
+    _retriers_lock = threading.Lock()
+
+    def __init__(self, service: str, key="", budgets=None, base=1.0, cap=60.0, breaker=None, window=50):
+        self.service = service
+        self.key = key
+        self.budgets = budgets or DEFAULT_BUDGETS
+        self.base = base
+        self.cap = cap
+        self.breaker = breaker or CircuitBreaker()
+        self._outcomes = deque(maxlen=window)
+        self._random = random.Random()
+
+    @classmethod
+    def for_service(cls, service: str, key="", **kwargs):
+        """
+        Return the retrier shared by every call to `service` in the process,
+        or to the part of it `key` names, e.g. one account and region.
+        `kwargs` configure it when it is first created.
+        """
+        with cls._retriers_lock:
+            if (service, key) not in cls._retriers:
+                cls._retriers[(service, key)] = cls(service, key=key, **kwargs)
+            return cls._retriers[(service, key)]
+
+    def throttle_rate(self) -> float:
+        """
+        Share of the recent calls that were throttled
+        """
+        outcomes = list(self._outcomes)
+        return sum(outcomes) / len(outcomes) if outcomes else 0.0
+
+    def call(self, fn, *args, idempotent=True, budgets=None, on_throttle=None, **kwargs):
+        """
+        Call `fn`, retrying the errors `classify` deems worth it within the budgets.
+        Transient errors are only retried if `fn` is `idempotent`, as the first
+        attempt may have gone through.
+        params:
+            - budgets(dict): replaces the retrier's budgets for this call
+            - on_throttle(callable): called with the backoff whenever the call is throttled
+        """
+        attempts = Counter()
+        while True:
+            time.sleep(self.breaker.wait_time())
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as err:
+                time.sleep(self._backoff(err, attempts, idempotent, budgets, on_throttle))
+                continue
+            self._record(False)
+            return result
+
+    async def acall(self, fn, *args, idempotent=True, budgets=None, on_throttle=None, **kwargs):
+        """
+        Coroutine version of `call`, `fn` returns an awaitable
+        """
+        attempts = Counter()
+        while True:
+            await asyncio.sleep(self.breaker.wait_time())
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as err:
+                await asyncio.sleep(self._backoff(err, attempts, idempotent, budgets, on_throttle))
+                continue
+            self._record(False)
+            return result
+
+    def _record(self, throttled: bool) -> None:
+        self._outcomes.append(throttled)
+        self.breaker.record(throttled)
+
+    def _backoff(self, err, attempts: Counter, idempotent: bool, budgets, on_throttle) -> float:
+        # re-raises `err` unless it should be retried, otherwise returns how long to wait first
+        error_class, retry_after = classify(err)
+        if error_class is not None:
+            self._record(error_class == "throttle")
+        budget = (budgets or self.budgets).get(error_class, 0)
+        if error_class is None or (error_class == "transient" and not idempotent) or attempts[error_class] >= budget:
+            raise err
+
+        delay = self._random.uniform(0, min(self.cap, self.base * 2 ** attempts[error_class]))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        attempts[error_class] += 1
+        Metrics.shared().inc("retries_total", service=self.service, error_class=error_class)
+        print(f"{self.service}{' ' + self.key if self.key else ''} call failed ({error_class}), retry {attempts[error_class]}/{budget} in {delay:.1f} sec: {err!r}")
+        if error_class == "throttle" and on_throttle:
+            on_throttle(delay)
+        return delay
+
+
+def aws_retrier(client, role_arn="") -> Retrier:
+    """
+    The retrier of the account and region a boto3 client calls, so throttling
+    in one of them does not pause, slow down or stop the watchers of the others
+    params:
+        - role_arn(str): role the client's credentials come from, "" for the default credentials
+    """
+    return Retrier.for_service("aws", key=f"{role_arn}@{client.meta.region_name}")
+
+
+def throttle_rate(client) -> float:
+    """
+    Share of the recent calls of a RetryingClient's account and region that were throttled, 0 for other clients
+    """
+    return client.retrier.throttle_rate() if isinstance(client, RetryingClient) else 0.0
+
+
+class RetryingClient(object):
+    """
+    A boto3 client whose API calls go through a Retrier; everything else
+    (meta, exceptions, paginators) is the wrapped client's
+    """
+
+    def __init__(self, client, retrier: Retrier):
+        self._client = client
+        self._retrier = retrier
+
+    @property
+    def retrier(self) -> Retrier:
+        return self._retrier
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self._client.meta.method_to_api_mapping:
+            return attr
+        return functools.partial(self._retrier.call, attr, idempotent=name.startswith(READ_ONLY_PREFIXES))
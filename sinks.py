@@ -0,0 +1,167 @@
+from collections import deque
+import threading
+
+from progress_bar import SlackProgress
+from startup import slack_mention
+
+# events whose handling waits on Slack, so they are handled outside the sink lock
+BLOCKING_EVENTS = ("started", "failures", "finished")
+
+
+def thread_ts_from_link(slack_link: str) -> str:
+    """
+    Message ts of a Slack message link, e.g. .../archives/C123/p1612345678000200 -> 1612345678.000200
+    """
+    slack_link_pts = slack_link.rpartition('/')[-1]
+    return f"{(slack_link_pts.split('p')[-1])[:-6]}.{(slack_link_pts.split('p')[-1])[-6:]}"
+
+
+def publish(sinks: list, event: dict) -> None:
+    for sink in sinks:
+        sink.publish(event)
+
+
+class DeploySink(object):
+    """
+    One Slack destination of a deployment, with its own token, channel, thread and formatting.
+    The watcher publishes normalized events (plain dicts) to every sink; each sink queues
+    them and applies them to its progress bar on its own thread, so a slow or rate-limited
+    channel never holds up the AWS poll or the other sinks.
+    Events:
+        - {"type": "started", "deployment_status", "iam_username"}
+        - {"type": "lifecycle", "instance_id", "lifecycle_event_name", "status", "instance_label", "percentage"}
+        - {"type": "summary", "summary", "percentage"}: fleet summary, rewritten in place under the bar
+        - {"type": "failures", "failures"}: lifecycle events that failed since the last poll, posted to the thread
+        - {"type": "status", "deployment_status"}: the deployment reached a final status
+        - {"type": "finished", "deployment_status", "iam_username"}: posted to the thread
+    params:
+        - deployment(dict): project_name, deployment_group_name, deployment_id and aws_region
+        - slack_link(str): link to a Slack message to post under, "" for a new message
+        - iam_slack_usernames_mapping(dict): IAM username -> Slack user id in this sink's workspace
+        - links(bool): link to the AWS console, off for audiences without AWS access
+        - state(dict): DeploySink.state() of a previous run, to resume without re-posting
+    """
+
+    def __init__(self, deployment: dict, slack_token: str, channel_name: str, slack_link="", iam_slack_usernames_mapping=None, links=True, state=None):
+        self.deployment = deployment
+        self.channel_name = channel_name
+        self.iam_slack_usernames_mapping = iam_slack_usernames_mapping or {}
+        self.links = links
+        self.resumed = bool(state)
+
+        aws_region = deployment["aws_region"]
+        title = f"*CodeDeploy: {deployment['project_name']} - {deployment['deployment_group_name']}*"
+        if links:
+            code_deploy_console_link = f"https://{aws_region}.console.aws.amazon.com/codesuite/codedeploy/deployments/{deployment['deployment_id']}?region={aws_region}"
+            self.prefix = f"<{code_deploy_console_link}|{title}>"
+        else:
+            self.prefix = title
+        msg_ts = thread_ts_from_link(slack_link) if slack_link else None
+        self.sp = SlackProgress(token=slack_token, channel=channel_name, prefix=self.prefix, msg_ts=msg_ts)
+
+        self.pbar = None
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._broken = False
+        if state:
+            if state["pbar"]:
+                self.pbar = self.sp.restore(state["pbar"])
+            self._pending.extend(state["pending"])
+        self._thread = threading.Thread(target=self._run, name=f"sink-{channel_name}", daemon=True)
+        self._thread.start()
+
+    def publish(self, event: dict) -> None:
+        """
+        Queue an event, never waiting on Slack
+        """
+        with self._cond:
+            self._pending.append(event)
+            self._cond.notify()
+
+    def state(self) -> dict:
+        """
+        JSON-serialisable progress bar and events not applied to it yet, for resuming
+        """
+        with self._cond:
+            return {
+                "pbar": self.pbar.state() if self.pbar else None,
+                "pending": [event for event in self._pending if event is not None],
+            }
+
+    def close(self, timeout=None) -> None:
+        """
+        Wait until every queued event has been sent, then stop the sink thread
+        """
+        self.publish(None)
+        self._thread.join(timeout)
+
+    def format(self, event: dict) -> str:
+        deployment_status = event.get("deployment_status")
+        if event["type"] == "started":
+            mention = slack_mention(event["iam_username"], self.iam_slack_usernames_mapping)
+            return f"Build: *{self.deployment['project_name']}*, DeploymentStatus=`{deployment_status}`, Initiated by: {mention}"
+
+        if event["type"] == "lifecycle":
+            instance_id = event["instance_id"]
+            log_message_emoji = ":blue_book:" if event["instance_label"] == 'Blue' else ":green_book:"
+            if self.links:
+                aws_region = self.deployment["aws_region"]
+                instance_link = f"https://{aws_region}.console.aws.amazon.com/ec2/v2/home?region={aws_region}#Instances:instanceId={instance_id}"
+                instance = f"<{instance_link}|*{instance_id}*>"
+            else:
+                instance = f"*{instance_id}*"
+            return f"Deployment's Phase: {event['lifecycle_event_name']}, [{log_message_emoji} {instance}] PhaseStatus=*{event['status']}*"
+
+        if event["type"] == "failures":
+            return "\n".join(self.format(dict(failure, type="lifecycle")) for failure in event["failures"])
+
+        if event["type"] == "status":
+            log_message_emoji = ":large_blue_circle:" if deployment_status == 'Succeeded' else ":red_circle:"
+            return f"Deploy: *{self.deployment['project_name']}*, DeployentStatus=`{deployment_status}`{log_message_emoji}"
+
+        mention = slack_mention(event["iam_username"], self.iam_slack_usernames_mapping)
+        return f"{self.prefix} *{deployment_status}!* {mention}"
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                event = self._pending[0]
+            if event is None:
+                return
+
+            if event["type"] in BLOCKING_EVENTS:
+                self._handle(event)
+                with self._cond:
+                    self._pending.popleft()
+            else:
+                # applied and dequeued under one lock, so state() never sees an event twice
+                with self._cond:
+                    self._handle(event)
+                    self._pending.popleft()
+
+    def _handle(self, event: dict) -> None:
+        if self._broken:
+            return
+        try:
+            if event["type"] == "started":
+                self.pbar = self.sp.new()
+                self.pbar.log(self.format(event))
+            elif event["type"] == "lifecycle":
+                self.pbar.pos = event["percentage"]
+                self.pbar.log(self.format(event))
+            elif event["type"] == "summary":
+                self.pbar.pos = event["percentage"]
+                self.pbar.status = event["summary"]
+            elif event["type"] == "failures":
+                self.pbar.log_thread(self.format(event))
+            elif event["type"] == "status":
+                self.pbar.pos = 100
+                self.pbar.log(self.format(event))
+            elif event["type"] == "finished":
+                self.pbar.log_thread(self.format(event))
+        except Exception as err:
+            print(f"slack sink {self.channel_name} failed on {event['type']}: {err!r}")
+            # without a message there is nothing later events could edit
+            self._broken = self.pbar is None
@@ -0,0 +1,129 @@
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+DEFAULT_STARTUP_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "aws-updates-to-slack", "startup.json")
+
+
+class TTLCache(object):
+    """
+    Small on-disk key/value cache whose entries expire after a per-call TTL
+    params:
+        - path(str): JSON file holding the cache
+    """
+
+    def __init__(self, path=DEFAULT_STARTUP_CACHE_PATH):
+        self.path = path
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key: str, ttl: float):
+        entry = self._load().get(key)
+        if not entry or time.time() - entry["stored_at"] > ttl:
+            return None
+        return entry["value"]
+
+    def put(self, key: str, value) -> None:
+        data = self._load()
+        data[key] = {"stored_at": time.time(), "value": value}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+class StartupProfiler(object):
+    """
+    Records how long each startup step takes, for `--profile_startup`
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started_at = time.perf_counter()
+        self.steps = []
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - start))
+
+    def report(self) -> None:
+        if not self.enabled:
+            return
+        total = time.perf_counter() - self.started_at
+        print(f"startup took {total:.3f} sec:")
+        for name, seconds in self.steps:
+            print(f"  {seconds:8.3f} sec  {name}")
+
+
+def credentials_key() -> str:
+    # different credentials must never share a cached identity
+    parts = [os.environ.get(name, "") for name in ("AWS_PROFILE", "AWS_ACCESS_KEY_ID", "AWS_ROLE_ARN", "AWS_WEB_IDENTITY_TOKEN_FILE")]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+
+def get_iam_identity(iam_slack_usernames_mapping: dict, cache: TTLCache, ttl=60 * 60) -> tuple:
+    """
+    Caller identity from STS, cached per set of credentials for `ttl` sec
+    returns: (slack mention or label of the caller, iam username, account id)
+    """
+    key = f"sts:{credentials_key()}"
+    identity = cache.get(key, ttl)
+    if identity is None:
+        import boto3
+
+        from metrics import instrument_client
+        from retry import RetryingClient, aws_client_config, aws_retrier
+
+        sts_client = instrument_client(boto3.client('sts', config=aws_client_config()))
+        sts_client = RetryingClient(sts_client, aws_retrier(sts_client))
+        response = sts_client.get_caller_identity()
+        identity = {"Arn": response['Arn'], "Account": response['Account']}
+        cache.put(key, identity)
+
+    iam_username = identity['Arn'].partition('/')[-1]
+    return slack_mention(iam_username, iam_slack_usernames_mapping), iam_username, identity['Account']
+
+
+def slack_mention(iam_username: str, iam_slack_usernames_mapping: dict) -> str:
+    """
+    Mention of the Slack user mapped to `iam_username`, or a plain label if there is none
+    """
+    if iam_slack_usernames_mapping.get(iam_username):
+        return f"<@{iam_slack_usernames_mapping[iam_username]}>"
+    return f"'AWS User {iam_username}'"
+
+
+def resolve_commit_id(git_repo_url: str, git_repo_branch: str, cache: TTLCache, ttl=60) -> str:
+    """
+    Head commit of a branch via `git ls-remote <url> refs/heads/<branch>`, cached per
+    url and branch for `ttl` sec (short, as the branch keeps moving)
+    """
+    key = f"git:{git_repo_url}:{git_repo_branch}"
+    commit_id = cache.get(key, ttl)
+    if commit_id:
+        return commit_id
+
+    output = subprocess.run(
+        ["git", "ls-remote", git_repo_url, f"refs/heads/{git_repo_branch}"],
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+    ).stdout
+    commit_id = output.partition("\t")[0].strip()
+    if commit_id:
+        cache.put(key, commit_id)
+    return commit_id